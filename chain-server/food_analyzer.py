@@ -5,17 +5,37 @@
 """
 
 import os
-import base64
+import asyncio
+import contextlib
+import functools
+import hashlib
+import io
+import multiprocessing
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Any, Literal
+from typing import Dict, List, Any, Literal, AsyncIterator
 import json
+import numpy as np
+import orjson
+import pybase64
+import sqlite3
+import time
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse
 
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage
-from langchain_core.output_parsers import JsonOutputParser
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from openai import OpenAI, APIConnectionError, InternalServerError, RateLimitError
+from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda
+from PIL import Image, ImageOps
 from pydantic import BaseModel, Field
 
 
@@ -35,10 +55,348 @@ class FoodAnalysis(BaseModel):
     confidence: float = Field(description="Уверенность в анализе от 0 до 1")
 
 
+# MIME-типы поддерживаемых изображений для data URL
+IMAGE_MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+ALLOWED_IMAGE_EXTENSIONS = frozenset(IMAGE_MIME_TYPES)
+# Pillow открывает большинство JPEG с камер телефонов как MPO (image/mpo), а это обычный JPEG
+IMAGE_FORMAT_MIME_OVERRIDES = {"MPO": "image/jpeg"}
+
+
+# Пул соединений к OpenAI, общий для всех ChatOpenAI в процессе
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+# Недоступный хост обнаруживается за секунды; общий таймаут ответа задает request_timeout модели
+HTTP_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+
+
+@functools.lru_cache(maxsize=None)
+def get_shared_http_client() -> httpx.Client:
+    """Общий синхронный HTTP/2 клиент с keep-alive для запросов к OpenAI."""
+    return httpx.Client(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+
+@functools.lru_cache(maxsize=None)
+def get_shared_async_http_client() -> httpx.AsyncClient:
+    """Общий асинхронный HTTP/2 клиент с keep-alive для запросов к OpenAI."""
+    return httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+
+async def close_shared_http_clients() -> None:
+    """Закрывает общие HTTP клиенты (при остановке сервера); при следующем обращении создаются заново."""
+    if get_shared_async_http_client.cache_info().currsize:
+        await get_shared_async_http_client().aclose()
+    if get_shared_http_client.cache_info().currsize:
+        get_shared_http_client().close()
+    # Анализаторы из фабрик держат ссылки на LLM и закрытые клиенты — сбрасываем и их
+    create_food_analyzer.cache_clear()
+    create_food_searcher.cache_clear()
+    get_shared_llm.cache_clear()
+    get_shared_async_http_client.cache_clear()
+    get_shared_http_client.cache_clear()
+
+
+@functools.lru_cache(maxsize=32)
+def get_shared_llm(model_name: str,
+                   temperature: float,
+                   max_tokens: int,
+                   request_timeout: float | None = None,
+                   max_retries: int = 2) -> ChatOpenAI:
+    """Общий экземпляр ChatOpenAI для набора параметров модели.
+
+    Анализаторы, создаваемые на каждый запрос, переиспользуют уже настроенный
+    клиент вместо повторного построения ChatOpenAI.
+    """
+    return ChatOpenAI(
+        model=model_name,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        request_timeout=request_timeout,
+        max_retries=max_retries,
+        http_client=get_shared_http_client(),
+        http_async_client=get_shared_async_http_client()
+    )
+
+
+# Временные ошибки OpenAI, после которых имеет смысл повторить запрос
+# (APITimeoutError — подкласс APIConnectionError). Ошибки входных данных
+# (FileNotFoundError, ValueError) возникают до вызова модели и не повторяются.
+RETRYABLE_OPENAI_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+OPENAI_RETRY_ATTEMPTS = 4
+
+
+def _with_openai_retry(runnable):
+    """Оборачивает вызов модели повтором временных ошибок с экспоненциальной задержкой и джиттером."""
+    return runnable.with_retry(
+        retry_if_exception_type=RETRYABLE_OPENAI_ERRORS,
+        wait_exponential_jitter=True,
+        stop_after_attempt=OPENAI_RETRY_ATTEMPTS,
+    )
+
+
+# Параметры предобработки изображений перед отправкой в OpenAI.
+# В режиме detail=high OpenAI сам приводит изображение к ~768 px по короткой стороне,
+# поэтому пиксели сверх 1024 px по длинной стороне только увеличивают объем запроса.
+MAX_IMAGE_SIDE = 1024
+JPEG_QUALITY = 75
+RECOMPRESS_MIN_BYTES = 512 * 1024
+
+
+def _downscale_to_jpeg(img: Image.Image, max_side: int, quality: int) -> tuple[memoryview, tuple[int, int]]:
+    """Уменьшает изображение до max_side по длинной стороне и пережимает в JPEG.
+
+    Returns:
+        Кортеж (буфер JPEG без копирования из BytesIO, итоговый размер (ширина, высота))
+    """
+    # Для JPEG декодер сразу уменьшает изображение в 2/4/8 раз (DCT-масштабирование), не
+    # распаковывая полное разрешение; вызов должен идти до exif_transpose, который загружает пиксели
+    img.draft("RGB", (max_side, max_side))
+    # EXIF при сохранении отбрасывается, поэтому ориентацию снимка с телефона применяем к пикселям
+    img = ImageOps.exif_transpose(img)
+    # reducing_gap: сначала быстрое целочисленное уменьшение (Image.reduce), затем LANCZOS
+    img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=quality, optimize=True)
+    return buf.getbuffer(), img.size
+
+
+# Размер блока чтения для потокового base64 (кратен 3, чтобы не было паддинга между блоками)
+B64_CHUNK_SIZE = 48 * 1024
+
+
+def _b64encode_file(image_path: str) -> str:
+    """Кодирует файл в base64 блоками, не держа в памяти сырые байты целиком."""
+    out = bytearray()
+    with open(image_path, "rb") as image_file:
+        while chunk := image_file.read(B64_CHUNK_SIZE):
+            out += pybase64.b64encode(chunk)
+    return out.decode("ascii")
+
+
+# Кэш хранит уже уменьшенные JPEG (~100–200 КБ base64), поэтому 128 записей занимают
+# десятки мегабайт — достаточно для повторов, ретраев и эскалации на другую модель
+ENCODED_IMAGE_CACHE_SIZE = 128
+
+
+def _image_mime_type(img: Image.Image, fallback: str | None = None) -> str:
+    """MIME-тип по фактическому формату изображения; неподдерживаемые форматы — ValueError."""
+    mime_type = IMAGE_FORMAT_MIME_OVERRIDES.get(img.format) or Image.MIME.get(img.format) or fallback
+    if mime_type not in IMAGE_MIME_TYPES.values():
+        raise ValueError(f"Неподдерживаемый формат изображения: {mime_type or 'неизвестен'}")
+    return mime_type
+
+
+@functools.lru_cache(maxsize=ENCODED_IMAGE_CACHE_SIZE)
+def _encode_image_cached(image_path: str, mtime_ns: int, size: int,
+                         max_side: int = MAX_IMAGE_SIDE,
+                         quality: int = JPEG_QUALITY) -> tuple[str, str, tuple[int, int]]:
+    """Кодирует файл в base64 и возвращает (base64, MIME-тип, размер изображения в пикселях).
+
+    Крупные по размеру файла или по разрешению изображения уменьшаются и пережимаются в JPEG,
+    остальные отправляются как есть. mtime и размер входят в ключ кэша для инвалидации.
+    """
+    with Image.open(image_path) as img:
+        # Image.open читает только заголовок; пиксели декодируются лишь при пережатии
+        if size > RECOMPRESS_MIN_BYTES or max(img.size) > max_side:
+            data, dimensions = _downscale_to_jpeg(img, max_side, quality)
+            return pybase64.b64encode(data).decode("ascii"), "image/jpeg", dimensions
+        dimensions = img.size
+        # MIME берем из фактического формата файла: расширение может не совпадать с содержимым
+        mime_type = _image_mime_type(img, IMAGE_MIME_TYPES.get(os.path.splitext(image_path)[1].lower()))
+    return _b64encode_file(image_path), mime_type, dimensions
+
+
+def _encode_image_bytes(data: bytes, max_side: int = MAX_IMAGE_SIDE,
+                        quality: int = JPEG_QUALITY) -> tuple[str, str, tuple[int, int]]:
+    """Кодирует изображение из памяти так же, как _encode_image_cached кодирует файл."""
+    with Image.open(io.BytesIO(data)) as img:
+        if len(data) > RECOMPRESS_MIN_BYTES or max(img.size) > max_side:
+            jpeg, dimensions = _downscale_to_jpeg(img, max_side, quality)
+            return pybase64.b64encode(jpeg).decode("ascii"), "image/jpeg", dimensions
+        dimensions = img.size
+        mime_type = _image_mime_type(img)
+    return pybase64.b64encode(data).decode("ascii"), mime_type, dimensions
+
+
+def _encode_image_file(image_path: str, max_side: int = MAX_IMAGE_SIDE,
+                       quality: int = JPEG_QUALITY) -> tuple[str, str, tuple[int, int]]:
+    """Кодирует локальный файл изображения; функция верхнего уровня для ProcessPoolExecutor."""
+    stat = os.stat(image_path)
+    return _encode_image_cached(image_path, stat.st_mtime_ns, stat.st_size, max_side, quality)
+
+
+def create_image_process_pool(max_workers: int | None = None) -> ProcessPoolExecutor:
+    """Пул процессов для пережатия и кодирования изображений.
+
+    Процессы запускаются через forkserver: в вызывающем процессе уже работают потоки
+    (to_thread, пулы HTTP-клиентов, логирование), и fork мог бы унаследовать их
+    захваченные локи. Пул стоит переиспользовать: в процессах живет кэш _encode_image_cached.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("forkserver"))
+
+
+class AnalysisCache:
+    """Персистентный JSON-кэш в SQLite с ограничением времени жизни записей.
+
+    Используется для результатов анализа изображений и для ответов Edamam.
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: int = 7 * 24 * 3600):
+        self.db_path = Path(db_path).expanduser()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        # Одно соединение на экземпляр: кэш читается на каждом запросе, и открытие файла
+        # на каждый get/set стоило бы дороже самого чтения. Доступ из потоков — под локом
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS analysis_cache ("
+            "key TEXT PRIMARY KEY, value_json TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("DELETE FROM analysis_cache WHERE expires_at <= ?", (time.time(),))
+
+    def get(self, key: str) -> Dict[str, Any] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value_json FROM analysis_cache WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        value_json = orjson.dumps(value).decode("utf-8")
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analysis_cache (key, value_json, expires_at) VALUES (?, ?, ?)",
+                (key, value_json, time.time() + self.ttl_seconds),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class TTLMemoryCache:
+    """Потокобезопасный LRU-кэш в памяти процесса с ограничением времени жизни записей."""
+
+    def __init__(self, max_entries: int = 4096, ttl_seconds: float = 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+class AsyncRateLimiter:
+    """Простой token-bucket ограничитель частоты запросов для asyncio.
+
+    Токены пополняются равномерно (max_requests за time_period секунд). Резервирование
+    токена выполняется синхронно, поэтому ограничитель безопасен для нескольких
+    корутин одного event loop и не привязан к конкретному loop.
+    """
+
+    def __init__(self, max_requests: int, time_period: float = 60.0):
+        self.max_requests = max_requests
+        self.time_period = time_period
+        self._rate = max_requests / time_period
+        self._tokens = float(max_requests)
+        self._last = time.monotonic()
+
+    def _reserve(self) -> float:
+        """Резервирует токен и возвращает время ожидания до его доступности."""
+        now = time.monotonic()
+        self._tokens = min(float(self.max_requests), self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self._rate
+
+    async def acquire(self) -> None:
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def __aenter__(self) -> "AsyncRateLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        return None
+
+
+class FoodAnalysisBatch(BaseModel):
+    """Модель результата анализа нескольких изображений в одном запросе."""
+    results: List[FoodAnalysis] = Field(description="Результаты анализа каждого изображения в порядке их следования")
+
+
+# Промпт анализа изображений: короткий список правил и блок примеров. Оба блока статичны
+# и отправляются системным сообщением перед изображением — одинаковый префикс запросов
+# позволяет OpenAI применять автоматическое кэширование промпта.
+IMAGE_ANALYSIS_RULES = """Ты эксперт по питанию. Найди на фото все блюда и продукты и для каждого укажи:
+название и описание на русском и английском, единицу измерения (unit_type) и количество.
+Оцени уверенность анализа (0-1).
+
+Правила:
+- Точно различай СОСТОЯНИЕ: сырое или приготовленное. В английском названии всегда указывай способ приготовления.
+- unit_type — только "штук", "грамм", "чашка", "кусок", "ломтик".
+- "грамм" (приоритет): нарезанные продукты, кусочки мяса/рыбы/овощей, каши, гарниры, салаты, пюре, блюда без четких границ.
+- "штук": только целые отдельные предметы (яйцо, яблоко, булочка, печенье). Несколько кусочков одного продукта — "грамм".
+- "кусок": крупные порционные куски (торт, сыр, отбивная), не мелкие кусочки.
+- "ломтик": тонкие ломтики (хлеб, колбаса, сыр).
+- "чашка": напитки и жидкие блюда в чашках/стаканах.
+- Количество оценивай по стандартным порциям; одинаковые блюда суммируй.
+"""
+
+IMAGE_ANALYSIS_EXAMPLES = """Примеры:
+- Овсянка в тарелке → "Овсяная каша" / "Cooked oatmeal porridge"; сухая → "Овсяные хлопья" / "Rolled oats"
+- Вареное яйцо → "Вареное яйцо" / "Hard-boiled egg", 1 штук; жареное → "Жареное яйцо" / "Fried egg"
+- Рис в тарелке → "Вареный рис" / "Cooked rice", 180 грамм; макароны → "Отварные макароны" / "Cooked pasta"
+- Гречка → "Гречневая каша" / "Cooked buckwheat porridge"
+- 6 кусочков жареной картошки → "Жареная картошка" / "Fried potatoes", 200 грамм (не "6 штук")
+- 5 кусочков нарезанной курицы → 150 грамм (не "5 кусков")
+- Салат из овощей → 120 грамм; целая булочка → 1 штук; кусок торта → 1 кусок
+"""
+
+IMAGE_ANALYSIS_PROMPT = f"{IMAGE_ANALYSIS_RULES}\n{IMAGE_ANALYSIS_EXAMPLES}"
+
+
 class FoodImageAnalyzer:
     """Анализатор изображений еды с помощью OpenAI Vision API."""
 
-    def __init__(self, model_name: str = "gpt-4o", temperature: float = 0.1, max_tokens: int = 1000):
+    def __init__(self, model_name: str = "gpt-4o-mini", temperature: float = 0.1, max_tokens: int = 500,
+                 max_concurrency: int = 10, rpm: int = 500,
+                 cache_path: str | None = None, cache_ttl_seconds: int = 7 * 24 * 3600,
+                 fallback_model_name: str | None = "gpt-4o", escalation_threshold: float = 0.5,
+                 low_detail_max_side: int = 512, max_image_side: int = MAX_IMAGE_SIDE,
+                 jpeg_quality: int = JPEG_QUALITY,
+                 image_detail: Literal["low", "high"] | None = None,
+                 request_timeout: float | None = None,
+                 two_pass_detail: bool = False):
         """
         Инициализация анализатора.
 
@@ -46,136 +404,379 @@ class FoodImageAnalyzer:
             model_name: Название модели OpenAI для анализа изображений
             temperature: Температура для генерации (0.0 - 1.0)
             max_tokens: Максимальное количество токенов в ответе
+            max_concurrency: Максимальное число одновременных запросов в пакетном анализе
+            rpm: Лимит запросов к OpenAI в минуту для асинхронного анализа
+            cache_path: Путь к SQLite-файлу кэша результатов (None — без кэша)
+            cache_ttl_seconds: Время жизни записи в кэше в секундах
+            fallback_model_name: Более точная модель для повторного анализа при низкой уверенности
+                (None — без эскалации)
+            escalation_threshold: Порог уверенности, ниже которого выполняется эскалация
+            low_detail_max_side: Изображения с длинной стороной не больше этого значения
+                отправляются с detail="low"
+            max_image_side: Максимальная длинная сторона изображения перед отправкой
+            jpeg_quality: Качество JPEG при пережатии изображений
+            image_detail: Фиксированный режим detail для всех изображений
+                (None — выбирается по размеру изображения через low_detail_max_side)
+            request_timeout: Таймаут запроса к OpenAI API в секундах (None — по умолчанию клиента)
+            two_pass_detail: Первый проход с detail="low"; при уверенности ниже escalation_threshold
+                повторный анализ с detail="high" (моделью fallback_model_name, если она задана)
         """
         self.model_name = model_name
-        self.llm = ChatOpenAI(
-            model=model_name,
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
-        self.parser = JsonOutputParser(pydantic_object=FoodAnalysis)
-
-        # Системный промпт для анализа изображений еды
-        self.system_prompt = """
-        Ты эксперт по питанию и кулинарии. Анализируй изображения еды и определяй:
-
-        1. Все блюда и продукты на изображении
-        2. Названия блюд на русском и английском языках
-        3. Описания блюд на русском и английском языках
-        4. Подходящую единицу измерения для каждого блюда
-        5. Количество каждого блюда в указанных единицах
-
-        КРИТИЧЕСКИ ВАЖНО - различай сырые и приготовленные продукты:
-        - Овсянка в тарелке = "Овсяная каша" / "Oatmeal porridge" или "Cooked oatmeal"
-        - Сухая овсянка = "Овсяные хлопья" / "Dry oats" или "Rolled oats"
-        - Вареное яйцо = "Вареное яйцо" / "Boiled egg" или "Hard-boiled egg"
-        - Жареное яйцо = "Жареное яйцо" / "Fried egg"
-        - Рис в тарелке = "Вареный рис" / "Cooked rice"
-        - Макароны в тарелке = "Отварные макароны" / "Cooked pasta"
-
-        Правила анализа:
-        - Будь максимально точен в определении СОСТОЯНИЯ блюд (сырое/приготовленное)
-        - Для unit_type используй только: "штук", "грамм", "чашка", "кусок", "ломтик"
-
-        ПРАВИЛА ВЫБОРА ЕДИНИЦ ИЗМЕРЕНИЯ (по приоритету):
-
-        1. ПРИОРИТЕТ: Используй "грамм" для:
-          * Всех нарезанных продуктов (картофель кусочками, нарезанное мясо, овощи дольками)
-          * Составных блюд и гарниров (каши, салаты, пюре, жареные овощи)
-          * Порезанных на кусочки продуктов (даже если это части одного предмета)
-          * Любых блюд без четких индивидуальных границ
-          * Мясных и рыбных блюд в виде кусочков или филе
-
-        2. Используй "штук" ТОЛЬКО для:
-          * Целых, неразделенных предметов (целое яйцо, целое яблоко, целая булочка)
-          * Отдельных изделий (печенье, конфета, орех в скорлупе)
-          * ВАЖНО: если видишь несколько кусочков одного продукта - это "грамм", не "штук"!
-
-        3. Используй "кусок" только для:
-          * Больших порционных кусков (кусок торта, кусок сыра, отбивная)
-          * НЕ используй для мелких нарезанных кусочков!
-
-        4. Используй "ломтик" для:
-          * Тонко нарезанных продуктов (хлеб, колбаса, сыр ломтиками)
-
-        5. Используй "чашка" для:
-          * Напитков и жидких блюд в чашках/стаканах
-
-        ПРИМЕРЫ ПРАВИЛЬНОГО ОПРЕДЕЛЕНИЯ:
-        - 6 кусочков жареной картошки → "200 грамм" (не "6 штук"!)
-        - 5 кусочков нарезанной курицы → "150 грамм" (не "5 кусков"!)
-        - 1 целое вареное яйцо → "1 штук"
-        - Порция риса → "180 грамм"
-        - Салат из овощей → "120 грамм"
-        - 1 целая булочка → "1 штук"
-        - Кусок торта → "1 кусок"
-
-        - Количество указывай разумно, учитывая стандартные порции
-        - Если на изображении несколько одинаковых блюд, указывай общее количество
-        - В английском названии ОБЯЗАТЕЛЬНО указывай способ приготовления
-        - Указывай уверенность в анализе (0-1)
-
-        Примеры правильных названий:
-        - "Овсяная каша" → "Cooked oatmeal porridge"
-        - "Вареное яйцо" → "Hard-boiled egg"
-        - "Жареная картошка" → "Fried potatoes"
-        - "Гречневая каша" → "Cooked buckwheat porridge"
-
-        Возвращай результат строго в указанном JSON формате.
-        """
+        self.fallback_model_name = fallback_model_name
+        self.escalation_threshold = escalation_threshold
+        self.low_detail_max_side = low_detail_max_side
+        self.max_image_side = max_image_side
+        self.jpeg_quality = jpeg_quality
+        self.image_detail = image_detail
+        self.two_pass_detail = two_pass_detail
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.max_concurrency = max_concurrency
+        self.limiter = AsyncRateLimiter(max_requests=rpm, time_period=60)
+        self.cache = AnalysisCache(cache_path, cache_ttl_seconds) if cache_path else None
+        # Повторы выполняются цепочкой (_with_openai_retry), встроенные повторы клиента отключены
+        self.llm = get_shared_llm(model_name, temperature, max_tokens, request_timeout, max_retries=0)
+        # Схема ответа передается в OpenAI (structured outputs) и проверяется на стороне API
+        self.structured_llm = self.llm.with_structured_output(FoodAnalysis, method="json_schema", strict=True)
+        self.fallback_llm = None
+        if fallback_model_name and fallback_model_name != model_name:
+            self.fallback_llm = get_shared_llm(fallback_model_name, temperature, max_tokens, request_timeout,
+                                               max_retries=0)
+
+        self.system_prompt = IMAGE_ANALYSIS_PROMPT
+        self._prompt_hash = hashlib.sha256(self.system_prompt.encode("utf-8")).hexdigest()[:8]
 
         self._build_chain()
 
-    def _encode_image(self, image_path: str) -> str:
-        """Кодирует изображение в base64."""
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+    @staticmethod
+    def _content_digest(image_path: str) -> str | None:
+        """blake2b-хэш содержимого локального изображения (None для URL и недоступных файлов)."""
+        if urlparse(image_path).scheme in ("http", "https"):
+            return None
+        try:
+            with open(image_path, "rb") as image_file:
+                return hashlib.file_digest(image_file, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+        except OSError:
+            return None
+
+    def _cache_key_for_digest(self, digest: str | None) -> str | None:
+        if self.cache is None or digest is None:
+            return None
+        detail_mode = "two-pass" if self.two_pass_detail else (self.image_detail or "auto")
+        return f"{digest}:{self.model_name}:{self._prompt_hash}:{detail_mode}"
+
+    def _cache_key(self, image_path: str) -> str | None:
+        """Ключ кэша: хэш содержимого изображения, модель и хэш промпта."""
+        if self.cache is None:
+            return None
+        return self._cache_key_for_digest(self._content_digest(image_path))
+
+    def _cache_get(self, key: str | None) -> Dict[str, Any] | None:
+        return self.cache.get(key) if key else None
+
+    def _cache_set(self, key: str | None, result: Dict[str, Any]) -> None:
+        if key and not result.get("error"):
+            self.cache.set(key, result)
 
-    def _prepare_image_message(self, image_path: str) -> Dict[str, Any]:
-        """Подготавливает сообщение с изображением для OpenAI API."""
-        if not os.path.exists(image_path):
+    def _encode_image(self, image_path: str) -> tuple[str, str, tuple[int, int]]:
+        """Кодирует изображение в base64 (с кэшированием по пути, mtime и размеру).
+
+        Returns:
+            Кортеж (base64-строка, MIME-тип, размер изображения в пикселях)
+        """
+        try:
+            stat = os.stat(image_path)
+        except FileNotFoundError:
             raise FileNotFoundError(f"Изображение не найдено: {image_path}")
+        return _encode_image_cached(image_path, stat.st_mtime_ns, stat.st_size,
+                                    self.max_image_side, self.jpeg_quality)
+
+    def _prepare_image_message(self, image_path: str,
+                               encoded: tuple[str, str, tuple[int, int]] | None = None,
+                               detail: str | None = None) -> Dict[str, Any]:
+        """Подготавливает сообщение с изображением для OpenAI API.
+
+        encoded — заранее подготовленный результат _encode_image (например, из пула процессов);
+        detail — режим detail для этого запроса (иначе image_detail или выбор по размеру).
+        """
+        detail = detail or self.image_detail
+        # Удаленные изображения передаем ссылкой, без скачивания и base64
+        if urlparse(image_path).scheme in ("http", "https"):
+            return {
+                "type": "image_url",
+                "image_url": {
+                    "url": image_path,
+                    "detail": detail or "high"
+                }
+            }
 
-        # Проверяем тип файла
-        allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
-        if Path(image_path).suffix.lower() not in allowed_extensions:
-            raise ValueError(f"Неподдерживаемый формат файла: {Path(image_path).suffix}")
+        if encoded is None:
+            # Проверяем тип файла
+            extension = os.path.splitext(image_path)[1]
+            if extension.lower() not in ALLOWED_IMAGE_EXTENSIONS:
+                raise ValueError(f"Неподдерживаемый формат файла: {extension}")
+            encoded = self._encode_image(image_path)
 
-        base64_image = self._encode_image(image_path)
+        base64_image, mime_type, dimensions = encoded
+        # Для небольших изображений режим high не добавляет деталей, но стоит в разы больше токенов
+        detail = detail or ("low" if max(dimensions) <= self.low_detail_max_side else "high")
 
         return {
             "type": "image_url",
             "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_image}",
-                "detail": "high"
+                "url": f"data:{mime_type};base64,{base64_image}",
+                "detail": detail
             }
         }
 
+    def _message_content(self, image_path: str,
+                         encoded: tuple[str, str, tuple[int, int]] | None = None,
+                         detail: str | None = None) -> List[Dict[str, Any]]:
+        """Формирует содержимое пользовательского сообщения (промпт передается системным сообщением)."""
+        return [self._prepare_image_message(image_path, encoded, detail)]
+
     def _build_chain(self):
         """Строит цепочку для анализа изображений."""
+        # Текст промпта статичен — системное сообщение собираем один раз
+        self._prompt_text = self.system_prompt
+        self._system_message = SystemMessage(content=self._prompt_text)
+
+        def create_message(inputs: Dict[str, Any]) -> List[SystemMessage | HumanMessage]:
+            """Создает статичное системное сообщение с промптом и сообщение с изображением."""
+            return [
+                self._system_message,
+                HumanMessage(content=self._message_content(inputs["image_path"], inputs.get("encoded"),
+                                                           inputs.get("detail")))
+            ]
+
+        async def acreate_message(inputs: Dict[str, Any]) -> List[SystemMessage | HumanMessage]:
+            """Асинхронный вариант: дожидается токена ограничителя частоты запросов.
+
+            Чтение, пережатие и base64-кодирование изображения выполняются в пуле потоков,
+            чтобы не блокировать event loop.
+            """
+            await self.limiter.acquire()
+            return await asyncio.to_thread(create_message, inputs)
+
+        def make_chain(structured_llm):
+            return (
+                RunnableLambda(create_message, afunc=acreate_message)
+                | _with_openai_retry(structured_llm)
+                | RunnableLambda(lambda analysis: analysis.model_dump())
+            )
 
-        def create_message(inputs: Dict[str, Any]) -> List[HumanMessage]:
-            """Создает сообщение с изображением и текстом."""
-            image_path = inputs["image_path"]
+        self.chain = make_chain(self.structured_llm)
 
-            image_content = self._prepare_image_message(image_path)
+        # Потоковый вариант: схема передается словарем, поэтому ответ разбирается
+        # JSON-парсером, который отдает частичные результаты по мере прихода токенов
+        self.stream_chain = (
+            RunnableLambda(create_message, afunc=acreate_message)
+            | self.llm.with_structured_output(FoodAnalysis.model_json_schema(), method="json_schema")
+        )
 
-            content = [
+        def create_multi_message(inputs: Dict[str, Any]) -> List[SystemMessage | HumanMessage]:
+            """Создает одно сообщение с несколькими пронумерованными изображениями."""
+            image_paths = inputs["image_paths"]
+            content: List[Dict[str, Any]] = [
                 {
                     "type": "text",
-                    "text": f"{self.system_prompt}\n\nФормат ответа:\n{self.parser.get_format_instructions()}"
-                },
-                image_content
+                    "text": (
+                        f"Ниже {len(image_paths)} отдельных изображений. "
+                        f"Проанализируй каждое независимо и верни в results ровно {len(image_paths)} "
+                        "результатов в том же порядке."
+                    )
+                }
             ]
-
-            return [HumanMessage(content=content)]
-
-        # Создаем цепочку
-        self.chain = (
-            RunnableLambda(create_message)
-            | self.llm
-            | self.parser
+            for i, image_path in enumerate(image_paths, 1):
+                content.append({"type": "text", "text": f"Изображение {i}:"})
+                content.append(self._prepare_image_message(image_path))
+            return [self._system_message, HumanMessage(content=content)]
+
+        async def acreate_multi_message(inputs: Dict[str, Any]) -> List[SystemMessage | HumanMessage]:
+            await self.limiter.acquire()
+            return await asyncio.to_thread(create_multi_message, inputs)
+
+        self.multi_chain = (
+            RunnableLambda(create_multi_message, afunc=acreate_multi_message)
+            | _with_openai_retry(self.llm.with_structured_output(FoodAnalysisBatch, method="json_schema", strict=True))
+            | RunnableLambda(lambda batch: [analysis.model_dump() for analysis in batch.results])
         )
+        self.fallback_chain = None
+        if self.fallback_llm is not None:
+            self.fallback_chain = make_chain(
+                self.fallback_llm.with_structured_output(FoodAnalysis, method="json_schema", strict=True)
+            )
+        # Повторный проход при низкой уверенности: точная модель, а в двухпроходном режиме
+        # без нее — та же модель с detail="high"
+        self.escalation_chain = self.fallback_chain
+        if self.escalation_chain is None and self.two_pass_detail:
+            self.escalation_chain = self.chain
+
+    @staticmethod
+    def _error_result(error: BaseException) -> Dict[str, Any]:
+        """Формирует результат анализа с ошибкой."""
+        return {
+            "error": str(error),
+            "dishes": [],
+            "confidence": 0.0
+        }
+
+    def _batch_config(self) -> Dict[str, Any]:
+        return {"max_concurrency": self.max_concurrency}
+
+    def _needs_escalation(self, result: Any) -> bool:
+        """Нужно ли повторить анализ более точной моделью и/или с detail="high"."""
+        if self.escalation_chain is None or not isinstance(result, dict):
+            return False
+        confidence = float(result.get("confidence") or 0.0)
+        if confidence < self.escalation_threshold:
+            model = self.fallback_model_name if self.fallback_chain is not None else self.model_name
+            detail = ", detail=high" if self.two_pass_detail else ""
+            print(f"⬆️ Уверенность {confidence:.2f} ниже порога — повторный анализ ({model}{detail})")
+            return True
+        return False
+
+    def _first_pass_inputs(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Вход первого прохода: в двухпроходном режиме — дешевый detail="low"."""
+        return {**inputs, "detail": "low"} if self.two_pass_detail else inputs
+
+    def _escalation_inputs(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Вход повторного прохода: в двухпроходном режиме — detail="high"."""
+        return {**inputs, "detail": "high"} if self.two_pass_detail else inputs
+
+    @staticmethod
+    def _apply_escalation(fresh: list, indices: list[int], escalated: list) -> list:
+        """Подставляет результаты эскалации; ошибки fallback-модели не затирают исходный результат."""
+        for j, result in zip(indices, escalated):
+            if not isinstance(result, Exception):
+                fresh[j] = result
+        return fresh
+
+    def _split_cached(self, image_paths: List[str]) -> tuple[list, list, list[list[int]]]:
+        """Готовит пакет к отправке.
+
+        Возвращает ключи кэша, результаты из кэша и группы индексов изображений без кэша.
+        Изображения с одинаковым содержимым попадают в одну группу и анализируются один раз.
+        """
+        digests = [self._content_digest(path) for path in image_paths]
+        keys = [self._cache_key_for_digest(digest) for digest in digests]
+        results: list = [self._cache_get(key) for key in keys]
+        groups: Dict[str, list[int]] = {}
+        for i, result in enumerate(results):
+            if result is None:
+                groups.setdefault(digests[i] or image_paths[i], []).append(i)
+        return keys, results, list(groups.values())
+
+    def _merge_fresh(self, keys: list, results: list, pending: list[list[int]], fresh: list) -> None:
+        """Раскладывает свежие результаты по позициям и сохраняет успешные в кэш."""
+        for group, result in zip(pending, fresh):
+            if isinstance(result, Exception):
+                result = self._error_result(result)
+            else:
+                self._cache_set(keys[group[0]], result)
+            for i in group:
+                results[i] = result
+
+    def _encodable(self, inputs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Входы с локальными файлами поддерживаемых форматов, которые можно закодировать заранее."""
+        return [item for item in inputs
+                if urlparse(item["image_path"]).scheme not in ("http", "https")
+                and os.path.splitext(item["image_path"])[1].lower() in ALLOWED_IMAGE_EXTENSIONS]
+
+    @staticmethod
+    def _encode_pool(workers: int | None,
+                     executor: ProcessPoolExecutor | None) -> contextlib.AbstractContextManager[ProcessPoolExecutor]:
+        """Переданный пул (не закрывается по выходу) или временный пул на workers процессов."""
+        return contextlib.nullcontext(executor) if executor is not None else create_image_process_pool(workers)
+
+    def _pre_encode(self, inputs: List[Dict[str, Any]], workers: int | None,
+                    executor: ProcessPoolExecutor | None = None) -> None:
+        """Кодирует изображения пакета в пуле процессов и добавляет результат во входы цепочки.
+
+        Пережатие и base64 нагружают CPU и упираются в GIL при потоках. Ошибки кодирования
+        не прерывают пакет: такие входы кодируются повторно в цепочке и получают обычную ошибку.
+        """
+        local = self._encodable(inputs)
+        if not local:
+            return
+        with self._encode_pool(workers, executor) as executor:
+            futures = [executor.submit(_encode_image_file, item["image_path"], self.max_image_side, self.jpeg_quality)
+                       for item in local]
+            for item, future in zip(local, futures):
+                if future.exception() is None:
+                    item["encoded"] = future.result()
+
+    async def _apre_encode(self, inputs: List[Dict[str, Any]], workers: int | None,
+                           executor: ProcessPoolExecutor | None = None) -> None:
+        """Асинхронный вариант _pre_encode: event loop ждет пул процессов, не блокируясь."""
+        local = self._encodable(inputs)
+        if not local:
+            return
+        loop = asyncio.get_running_loop()
+        with self._encode_pool(workers, executor) as executor:
+            encoded = await asyncio.gather(
+                *(loop.run_in_executor(executor, _encode_image_file, item["image_path"],
+                                       self.max_image_side, self.jpeg_quality) for item in local),
+                return_exceptions=True
+            )
+        for item, result in zip(local, encoded):
+            if not isinstance(result, BaseException):
+                item["encoded"] = result
+
+    def _analyze(self, inputs: Dict[str, Any], key: str | None) -> Dict[str, Any]:
+        """Анализ с кэшем и эскалацией на точную модель при низкой уверенности."""
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        try:
+            result = self.chain.invoke(self._first_pass_inputs(inputs))
+        except Exception as e:
+            return self._error_result(e)
+        if self._needs_escalation(result):
+            try:
+                result = self.escalation_chain.invoke(self._escalation_inputs(inputs))
+            except Exception:
+                pass
+        self._cache_set(key, result)
+        return result
+
+    async def _aanalyze(self, inputs: Dict[str, Any], key: str | None) -> Dict[str, Any]:
+        """Асинхронный вариант _analyze."""
+        cached = await asyncio.to_thread(self._cache_get, key)
+        if cached is not None:
+            return cached
+        try:
+            result = await self.chain.ainvoke(self._first_pass_inputs(inputs))
+        except Exception as e:
+            return self._error_result(e)
+        if self._needs_escalation(result):
+            try:
+                result = await self.escalation_chain.ainvoke(self._escalation_inputs(inputs))
+            except Exception:
+                pass
+        await asyncio.to_thread(self._cache_set, key, result)
+        return result
+
+    def _bytes_inputs(self, data: bytes) -> tuple[Dict[str, Any], str | None]:
+        """Готовит вход цепочки и ключ кэша для изображения в памяти."""
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        encoded = _encode_image_bytes(data, self.max_image_side, self.jpeg_quality)
+        return {"image_path": "<bytes>", "encoded": encoded}, self._cache_key_for_digest(digest)
+
+    async def _abytes_inputs(self, data: bytes,
+                             executor: ProcessPoolExecutor | None = None) -> tuple[Dict[str, Any], str | None]:
+        """Асинхронный вариант _bytes_inputs.
+
+        С executor пережатие и кодирование (CPU) выполняются в пуле процессов, и несколько
+        изображений обрабатываются на разных ядрах; иначе — в пуле потоков.
+        """
+        if executor is None:
+            return await asyncio.to_thread(self._bytes_inputs, data)
+        loop = asyncio.get_running_loop()
+        digest = await asyncio.to_thread(lambda: hashlib.blake2b(data, digest_size=16).hexdigest())
+        encoded = await loop.run_in_executor(executor, _encode_image_bytes, data,
+                                             self.max_image_side, self.jpeg_quality)
+        return {"image_path": "<bytes>", "encoded": encoded}, self._cache_key_for_digest(digest)
 
     def analyze_image(self, image_path: str) -> Dict[str, Any]:
         """
@@ -184,33 +785,268 @@ class FoodImageAnalyzer:
         Args:
             image_path: Путь к файлу изображения
 
+        Returns:
+            Словарь с результатами анализа
+        """
+        return self._analyze({"image_path": image_path}, self._cache_key(image_path))
+
+    async def analyze_image_async(self, image_path: str) -> Dict[str, Any]:
+        """
+        Асинхронно анализирует изображение еды.
+
+        Args:
+            image_path: Путь к файлу изображения
+
+        Returns:
+            Словарь с результатами анализа
+        """
+        key = await asyncio.to_thread(self._cache_key, image_path)
+        return await self._aanalyze({"image_path": image_path}, key)
+
+    def analyze_image_bytes(self, data: bytes) -> Dict[str, Any]:
+        """
+        Анализирует изображение, уже загруженное в память (например, из HTTP-запроса).
+
+        Байты сразу проходят пережатие и base64-кодирование, без записи во временный файл.
+        Формат определяется по содержимому.
+
+        Args:
+            data: Содержимое файла изображения
+
         Returns:
             Словарь с результатами анализа
         """
         try:
-            result = self.chain.invoke({"image_path": image_path})
-            return result
+            inputs, key = self._bytes_inputs(data)
         except Exception as e:
-            return {
-                "error": str(e),
-                "dishes": [],
-                "confidence": 0.0
-            }
+            return self._error_result(e)
+        return self._analyze(inputs, key)
+
+    async def analyze_image_bytes_async(self, data: bytes,
+                                        executor: ProcessPoolExecutor | None = None) -> Dict[str, Any]:
+        """
+        Асинхронный вариант analyze_image_bytes (кодирование выполняется в пуле потоков).
+
+        Args:
+            data: Содержимое файла изображения
+            executor: Пул процессов для пережатия и кодирования (None — пул потоков)
+
+        Returns:
+            Словарь с результатами анализа
+        """
+        try:
+            inputs, key = await self._abytes_inputs(data, executor)
+        except Exception as e:
+            return self._error_result(e)
+        return await self._aanalyze(inputs, key)
+
+    async def analyze_image_stream(self, image_path: str | bytes,
+                                   executor: ProcessPoolExecutor | None = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Анализирует изображение в потоковом режиме.
+
+        Отдает частично разобранный результат по мере генерации ответа моделью, чтобы
+        вызывающий код мог начать работу с блюдами до окончания ответа.
+
+        Args:
+            image_path: Путь к файлу изображения или его содержимое в памяти
+            executor: Пул процессов для пережатия и кодирования (None — пул потоков)
+
+        Yields:
+            Частичные (и в конце полный) словари с результатами анализа
+        """
+        try:
+            if isinstance(image_path, bytes):
+                inputs, _ = await self._abytes_inputs(image_path, executor)
+            else:
+                inputs = {"image_path": image_path}
+            async for partial in self.stream_chain.astream(inputs):
+                yield partial
+        except Exception as e:
+            yield self._error_result(e)
+
+    async def analyze_batch_async(self, image_paths: List[str], workers: int | None = None,
+                                  executor: ProcessPoolExecutor | None = None) -> List[Dict[str, Any]]:
+        """
+        Асинхронно анализирует несколько изображений параллельно.
+
+        Число одновременных запросов к OpenAI ограничено max_concurrency.
+
+        Args:
+            image_paths: Список путей к изображениям
+            workers: Число процессов для предварительного пережатия и base64-кодирования
+                (None — кодирование в пуле потоков по ходу запросов)
+            executor: Готовый пул процессов (см. create_image_process_pool) вместо временного
+                пула на workers процессов
+
+        Returns:
+            Список результатов анализа в порядке входных путей
+        """
+        keys, results, pending = await asyncio.to_thread(self._split_cached, image_paths)
+        if pending:
+            inputs = [{"image_path": image_paths[group[0]]} for group in pending]
+            if workers or executor is not None:
+                await self._apre_encode(inputs, workers, executor)
+            fresh = await self.chain.abatch([self._first_pass_inputs(item) for item in inputs],
+                                            config=self._batch_config(), return_exceptions=True)
+            indices = [j for j, result in enumerate(fresh) if self._needs_escalation(result)]
+            if indices:
+                escalated = await self.escalation_chain.abatch(
+                    [self._escalation_inputs(inputs[j]) for j in indices],
+                    config=self._batch_config(), return_exceptions=True
+                )
+                fresh = self._apply_escalation(fresh, indices, escalated)
+            await asyncio.to_thread(self._merge_fresh, keys, results, pending, fresh)
+        return results
 
-    def analyze_batch(self, image_paths: List[str]) -> List[Dict[str, Any]]:
+    def analyze_batch(self, image_paths: List[str], mode: Literal["interactive", "batch"] = "interactive",
+                      workers: int | None = None,
+                      executor: ProcessPoolExecutor | None = None) -> List[Dict[str, Any]]:
         """
-        Анализирует несколько изображений.
+        Анализирует несколько изображений параллельно.
 
         Args:
             image_paths: Список путей к изображениям
+            mode: "interactive" — параллельные запросы Chat Completions;
+                "batch" — фоновая обработка через OpenAI Batch API (см. analyze_batch_offline)
+            workers: Число процессов для предварительного пережатия и base64-кодирования
+                в режиме "interactive" (например, os.cpu_count(); None — без пула процессов)
+            executor: Готовый пул процессов (см. create_image_process_pool) вместо временного
+                пула на workers процессов
 
         Returns:
             Список результатов анализа
         """
-        results = []
-        for image_path in image_paths:
-            result = self.analyze_image(image_path)
-            results.append(result)
+        if mode == "batch":
+            return self.analyze_batch_offline(image_paths)
+        keys, results, pending = self._split_cached(image_paths)
+        if pending:
+            inputs = [{"image_path": image_paths[group[0]]} for group in pending]
+            if workers or executor is not None:
+                self._pre_encode(inputs, workers, executor)
+            fresh = self.chain.batch([self._first_pass_inputs(item) for item in inputs],
+                                     config=self._batch_config(), return_exceptions=True)
+            indices = [j for j, result in enumerate(fresh) if self._needs_escalation(result)]
+            if indices:
+                escalated = self.escalation_chain.batch(
+                    [self._escalation_inputs(inputs[j]) for j in indices],
+                    config=self._batch_config(), return_exceptions=True
+                )
+                fresh = self._apply_escalation(fresh, indices, escalated)
+            self._merge_fresh(keys, results, pending, fresh)
+        return results
+
+    def analyze_batch_offline(self, image_paths: List[str], poll_interval: float = 30.0,
+                              timeout: float = 24 * 3600) -> List[Dict[str, Any]]:
+        """
+        Анализирует изображения через OpenAI Batch API.
+
+        Подходит для фоновых задач без жестких требований к задержке: пакет обрабатывается
+        до 24 часов, но стоит вдвое дешевле и не расходует лимиты RPM интерактивных запросов.
+        Метод блокируется до завершения пакета (или истечения timeout).
+
+        Args:
+            image_paths: Список путей к изображениям
+            poll_interval: Интервал опроса статуса пакета в секундах
+            timeout: Максимальное время ожидания в секундах; по истечении пакет отменяется
+
+        Returns:
+            Список результатов анализа в порядке входных путей
+        """
+        results: List[Dict[str, Any] | None] = [None] * len(image_paths)
+        lines = []
+        for i, image_path in enumerate(image_paths):
+            try:
+                content = self._message_content(image_path)
+            except Exception as e:
+                results[i] = self._error_result(e)
+                continue
+            lines.append(json.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model_name,
+                    "temperature": self.temperature,
+                    "max_tokens": self.max_tokens,
+                    "messages": [
+                        {"role": "system", "content": self._prompt_text},
+                        {"role": "user", "content": content},
+                    ],
+                    "response_format": {
+                        "type": "json_schema",
+                        "json_schema": {"name": "FoodAnalysis", "schema": FoodAnalysis.model_json_schema()},
+                    },
+                },
+            }, ensure_ascii=False))
+        if not lines:
+            return results
+
+        client = OpenAI(http_client=get_shared_http_client())
+        batch_file = client.files.create(
+            file=("analyze_batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"📦 Пакет OpenAI {batch.id} создан: {len(lines)} изображений")
+
+        deadline = time.monotonic() + timeout
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            if time.monotonic() > deadline:
+                batch = client.batches.cancel(batch.id)
+                break
+            time.sleep(poll_interval)
+            batch = client.batches.retrieve(batch.id)
+
+        if batch.output_file_id:
+            for line in client.files.content(batch.output_file_id).text.splitlines():
+                record = json.loads(line)
+                i = int(record["custom_id"])
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    results[i] = self._error_result(RuntimeError(str(record.get("error") or response.get("body"))))
+                    continue
+                try:
+                    message = response["body"]["choices"][0]["message"]["content"]
+                    results[i] = FoodAnalysis.model_validate_json(message).model_dump()
+                except Exception as e:
+                    results[i] = self._error_result(e)
+
+        status_error = RuntimeError(f"Пакет OpenAI {batch.id} завершился со статусом {batch.status}")
+        return [result if result is not None else self._error_result(status_error) for result in results]
+
+    def analyze_multi(self, image_paths: List[str], k: int = 4) -> List[Dict[str, Any]]:
+        """
+        Анализирует изображения группами по k штук в одном запросе к OpenAI.
+
+        Снижает число запросов (и расход лимита RPM) в k раз; подходит для небольших изображений.
+
+        Args:
+            image_paths: Список путей к изображениям
+            k: Количество изображений в одном запросе
+
+        Returns:
+            Список результатов анализа в порядке входных путей
+        """
+        chunks = [image_paths[i:i + k] for i in range(0, len(image_paths), k)]
+        responses = self.multi_chain.batch(
+            [{"image_paths": chunk} for chunk in chunks],
+            config=self._batch_config(),
+            return_exceptions=True,
+        )
+        results: List[Dict[str, Any]] = []
+        for chunk, response in zip(chunks, responses):
+            if isinstance(response, Exception):
+                results.extend(self._error_result(response) for _ in chunk)
+            elif len(response) != len(chunk):
+                error = ValueError(f"Модель вернула {len(response)} результатов вместо {len(chunk)}")
+                results.extend(self._error_result(error) for _ in chunk)
+            else:
+                results.extend(response)
         return results
 
 
@@ -248,62 +1084,8 @@ class MultipleNutrientAnalysis(BaseModel):
     dishes: List[NutrientAnalysis] = Field(description="Список результатов анализа для каждого блюда")
 
 
-def _safe_pretty(obj: Any, max_len: int = 2000) -> str:
-    """Безопасно формирует строку для печати с ограничением длины."""
-    try:
-        if isinstance(obj, str):
-            s = obj
-        else:
-            s = json.dumps(obj, ensure_ascii=False, indent=2)
-    except Exception:
-        s = str(obj)
-    if len(s) > max_len:
-        return s[:max_len] + "\n...[truncated]..."
-    return s
-
-
-class EdamamFoodSearcher:
-    """Анализатор питательных веществ через Edamam API и OpenAI."""
-
-    def __init__(self, app_id: str, app_key: str, base_url: str, timeout: int = 30, max_results: int = 3,
-                 model_name: str = "gpt-4o", temperature: float = 0.5, max_tokens: int = 800,
-                 request_timeout: int = 45,
-                 debug_api_log: bool = False,
-                 debug_max_chars: int = 2000):
-        """
-        Инициализация анализатора.
-
-        Args:
-            app_id: ID приложения Edamam
-            app_key: Ключ приложения Edamam
-            base_url: Базовый URL API
-            timeout: Таймаут запроса к Edamam API в секундах
-            max_results: Максимальное количество результатов
-            model_name: Название модели OpenAI
-            temperature: Температура для генерации
-            max_tokens: Максимальное количество токенов
-            request_timeout: Таймаут запроса к OpenAI API в секундах
-        """
-        self.app_id = app_id
-        self.app_key = app_key
-        self.base_url = base_url
-        self.timeout = timeout
-        self.max_results = max_results
-        self.debug_api_log = debug_api_log
-        self.debug_max_chars = debug_max_chars
-
-        # Инициализация OpenAI модели для анализа питательных веществ
-        self.llm = ChatOpenAI(
-            model=model_name,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            request_timeout=request_timeout
-        )
-        self.nutrient_parser = JsonOutputParser(pydantic_object=NutrientAnalysis)
-        self.multiple_nutrient_parser = JsonOutputParser(pydantic_object=MultipleNutrientAnalysis)
-
-        # Системный промпт для анализа питательных веществ
-        self.nutrient_prompt = """
+# Системный промпт для анализа питательных веществ
+NUTRIENT_PROMPT = """
         Ты эксперт по питанию. Проанализируй данные о еде из Edamam API и определи питательную ценность блюда.
 
         ВАЖНО: Все данные в Edamam API указаны на 100 грамм продукта!
@@ -373,182 +1155,11 @@ class EdamamFoodSearcher:
         - Прямой расчет: 250г
         - Если продукт содержит 68 ккал на 100г, то: (68 * 250) / 100 = 170.0 ккал
 
-        Возвращай результат строго в указанном JSON формате.
-        """
-
-        self._build_chain()
-
-    def _optimize_search_term(self, dish_name: str) -> str:
-        """Оптимизирует поисковый термин для лучшего поиска в Edamam API."""
-        # Приводим к нижнему регистру для сравнения
-        dish_lower = dish_name.lower()
-
-        # Словарь для улучшения поисковых запросов
-        search_optimizations = {
-            # Приготовленные блюда
-            "cooked oatmeal": "oatmeal cooked",
-            "oatmeal porridge": "oatmeal cooked",
-            "cooked oatmeal porridge": "oatmeal cooked",
-            "hard-boiled egg": "egg boiled",
-            "boiled egg": "egg boiled",
-            "soft-boiled egg": "egg boiled",
-            "fried egg": "egg fried",
-            "scrambled eggs": "egg scrambled",
-            "cooked rice": "rice cooked",
-            "cooked pasta": "pasta cooked",
-            "cooked buckwheat": "buckwheat cooked",
-            "cooked quinoa": "quinoa cooked",
-
-            # Исправления для популярных продуктов
-            "buckwheat porridge": "buckwheat cooked",
-            "rice porridge": "rice cooked",
-            "millet porridge": "millet cooked",
-            "pearl barley porridge": "barley cooked",
-
-            # Овощи
-            "fried potatoes": "potato fried",
-            "mashed potatoes": "potato mashed",
-            "boiled potatoes": "potato boiled",
-            "baked potato": "potato baked",
-
-            # Мясо и рыба
-            "grilled chicken": "chicken grilled",
-            "fried chicken": "chicken fried",
-            "baked fish": "fish baked",
-            "grilled fish": "fish grilled",
-
-            # Молочные продукты
-            "greek yogurt": "yogurt greek",
-            "cottage cheese": "cheese cottage",
-        }
-
-        # Проверяем, есть ли оптимизация для данного блюда
-        for dish_key, optimized_term in search_optimizations.items():
-            if dish_key in dish_lower:
-                return optimized_term
-
-        # Если точного совпадения нет, применяем общие правила
-        if "cooked" in dish_lower or "porridge" in dish_lower:
-            # Убираем слова "cooked" и "porridge" и добавляем "cooked" в конец
-            base_dish = dish_lower.replace("cooked ", "").replace(" porridge", "").replace("porridge", "")
-            return f"{base_dish.strip()} cooked"
-
-        if "boiled" in dish_lower or "hard-boiled" in dish_lower:
-            # Для вареных продуктов
-            base_dish = dish_lower.replace("hard-boiled ", "").replace("boiled ", "").replace(" boiled", "")
-            return f"{base_dish.strip()} boiled"
-
-        if "fried" in dish_lower:
-            # Для жареных продуктов
-            base_dish = dish_lower.replace("fried ", "").replace(" fried", "")
-            return f"{base_dish.strip()} fried"
-
-        # Если никаких правил не применилось, возвращаем оригинальное название
-        return dish_name
-
-    def _search_single_dish(self, dish_name: str) -> Dict[str, Any]:
-        """Поиск одного блюда в Edamam API."""
-        # Улучшаем поисковый запрос для лучшего поиска приготовленных блюд
-        search_term = self._optimize_search_term(dish_name)
-
-        # Логируем оптимизацию поиска если термин изменился
-        if search_term.lower() != dish_name.lower():
-            print(f"🔍 Поиск оптимизирован: '{dish_name}' → '{search_term}'")
-
-        params = {
-            "app_id": self.app_id,
-            "app_key": self.app_key,
-            "ingr": search_term,
-        }
-
-        try:
-            response = requests.get(self.base_url, params=params, timeout=self.timeout)
-            response.raise_for_status()
-            data = response.json()
-
-            if self.debug_api_log:
-                print("===== Edamam RAW response =====")
-                print(_safe_pretty(data, self.debug_max_chars))
-                print("===== /Edamam RAW response =====")
-
-            # Ограничиваем количество результатов
-            if "parsed" in data and len(data["parsed"]) > self.max_results:
-                data["parsed"] = data["parsed"][:self.max_results]
-            if "hints" in data and len(data["hints"]) > self.max_results:
-                data["hints"] = data["hints"][:self.max_results]
-
-            # Логируем количество найденных результатов
-            parsed_count = len(data.get("parsed", []))
-            hints_count = len(data.get("hints", []))
-            print(f"📊 Edamam поиск '{search_term}': parsed={parsed_count}, hints={hints_count}")
-
-            return {
-                "dish_name": dish_name,
-                "search_term": search_term,
-                "success": True,
-                "data": data
-            }
-
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Ошибка поиска в Edamam для '{search_term}': {str(e)}")
-            return {
-                "dish_name": dish_name,
-                "search_term": search_term,
-                "success": False,
-                "error": str(e),
-                "data": None
-            }
-
-    def _analyze_nutrients_with_llm(self, edamam_data: Dict[str, Any], dish: str, amount: float, unit: str, search_term: str = None) -> Dict[str, Any]:
-        """Анализ питательных веществ через OpenAI на основе данных Edamam."""
-        try:
-            # Формируем полное название блюда с количеством
-            dish_with_amount = f"{dish} ({amount} {unit})"
-
-            # Формируем запрос для LLM
-            user_query = f"""
-            Блюдо: {dish}
-            Количество: {amount} {unit}
-            Поисковый термин в Edamam: {search_term or dish}
-
-            Данные от Edamam API:
-            {json.dumps(edamam_data, ensure_ascii=False, indent=2)}
-
-            Проанализируй и рассчитай питательную ценность для указанного количества блюда.
-            ОБЯЗАТЕЛЬНО выбери продукт правильного состояния (приготовленный/сырой) основываясь на поисковом термине.
-            В поле dish_name укажи: "{dish_with_amount}"
-            """
-
-            # Создаем сообщение
-            messages = [
-                HumanMessage(content=f"{self.nutrient_prompt}\n\nФормат ответа:\n{self.nutrient_parser.get_format_instructions()}\n\n{user_query}")
-            ]
-
-            # Получаем ответ от LLM
-            response = self.llm.invoke(messages)
-            if self.debug_api_log:
-                print("===== LLM RAW response (single) =====")
-                print(_safe_pretty(getattr(response, 'content', response), self.debug_max_chars))
-                print("===== /LLM RAW response (single) =====")
-            nutrients = self.nutrient_parser.parse(response.content)
-
-            return {
-                "success": True,
-                "nutrients": nutrients
-            }
-
-        except Exception as e:
-            return {
-                "success": False,
-                "error": f"Ошибка анализа питательных веществ: {str(e)}",
-                "nutrients": None
-            }
+        Возвращай результат по заданной схеме ответа.
+"""
 
-    def _analyze_multiple_nutrients_with_llm(self, edamam_data_list: List[Dict[str, Any]], dishes_info: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """Анализ питательных веществ множественных блюд через OpenAI на основе данных Edamam."""
-        try:
-            # Формируем системный промпт для множественного анализа
-            multiple_nutrient_prompt = """
+# Системный промпт для анализа питательных веществ нескольких блюд
+MULTIPLE_NUTRIENT_PROMPT = """
             Ты эксперт по питанию. Проанализируй данные о нескольких блюдах из Edamam API и определи питательную ценность каждого блюда.
 
             ВАЖНО: Все данные в Edamam API указаны на 100 грамм продукта!
@@ -602,103 +1213,825 @@ class EdamamFoodSearcher:
             - Округляй результаты до 1 знака после запятой
             - В поле dish_name укажи название блюда с количеством, как указано в запросе
 
-            Возвращай результат строго в указанном JSON формате для ВСЕХ блюд.
-            """
-
-            # Формируем запрос для LLM с информацией о всех блюдах
-            user_query = f"""
-            Анализируй следующие блюда:
+            Возвращай результат по заданной схеме ответа для ВСЕХ блюд.
+"""
 
-            """
 
-            for i, (dish_info, edamam_data) in enumerate(zip(dishes_info, edamam_data_list), 1):
-                dish = dish_info["dish"]
-                amount = dish_info["amount"]
-                unit = dish_info["unit"]
-                search_term = dish_info.get("search_term", dish)
+# Нутриенты Edamam, используемые в расчете: калории, белки, жиры, углеводы, клетчатка
+EDAMAM_NUTRIENT_KEYS = ("ENERC_KCAL", "PROCNT", "FAT", "CHOCDF", "FIBTG")
+EDAMAM_MAX_MEASURES = 6
+
+
+def _slim_edamam_food(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Проекция одного продукта Edamam: название, категория, нутриенты на 100 г и единицы измерения."""
+    food = entry.get("food") or {}
+    nutrients = food.get("nutrients") or {}
+    slim: Dict[str, Any] = {
+        "label": food.get("label"),
+        # Категория ("Generic foods", "Packaged foods", ...) помогает выбрать обычный продукт вместо брендового
+        "category": food.get("category"),
+        "nutrients": {key: nutrients[key] for key in EDAMAM_NUTRIENT_KEYS if key in nutrients},
+    }
+    measures = entry.get("measures")
+    if measures:
+        slim["measures"] = [
+            {
+                "label": measure.get("label"),
+                "weight": measure.get("weight"),
+                "qualified": [
+                    {
+                        "qualifiers": [q.get("label") for q in qualified.get("qualifiers", [])],
+                        "weight": qualified.get("weight"),
+                    }
+                    for qualified in measure.get("qualified", [])
+                ],
+            }
+            for measure in measures[:EDAMAM_MAX_MEASURES]
+        ]
+    return slim
 
-                user_query += f"""
-            Блюдо {i}:
-            Название: {dish}
-            Количество: {amount} {unit}
-            Поисковый термин в Edamam: {search_term}
 
-            Данные от Edamam API для блюда {i}:
-            {json.dumps(edamam_data, ensure_ascii=False, indent=2)}
+def _slim_edamam(data: Dict[str, Any], max_results: int) -> Dict[str, Any]:
+    """Сокращает ответ Edamam до полей, которые использует промпт расчета нутриентов.
 
-            ---
+    Изображения, URI, бренды и прочие метаданные только увеличивают число входных токенов.
+    """
+    return {
+        "parsed": [_slim_edamam_food(entry) for entry in (data.get("parsed") or [])[:max_results]],
+        "hints": [_slim_edamam_food(entry) for entry in (data.get("hints") or [])[:max_results]],
+    }
 
-            """
 
-            user_query += """
-            Проанализируй и рассчитай питательную ценность для каждого блюда в указанном количестве.
-            ОБЯЗАТЕЛЬНО выбери продукт правильного состояния (приготовленный/сырой) основываясь на поисковом термине.
-            """
+def _compact_json(obj: Any) -> str:
+    """Сериализует данные для промпта без отступов и пробелов — меньше входных токенов."""
+    return orjson.dumps(obj).decode("utf-8")
 
-            # Создаем сообщение
-            messages = [
-                HumanMessage(content=f"{multiple_nutrient_prompt}\n\nФормат ответа:\n{self.multiple_nutrient_parser.get_format_instructions()}\n\n{user_query}")
-            ]
 
-            # Получаем ответ от LLM
-            response = self.llm.invoke(messages)
-            if self.debug_api_log:
-                print("===== LLM RAW response (multiple) =====")
-                print(_safe_pretty(getattr(response, 'content', response), self.debug_max_chars))
-                print("===== /LLM RAW response (multiple) =====")
-            nutrients = self.multiple_nutrient_parser.parse(response.content)
+def _safe_pretty(obj: Any, max_len: int = 2000) -> str:
+    """Безопасно формирует строку для печати с ограничением длины."""
+    try:
+        if isinstance(obj, str):
+            s = obj
+        else:
+            s = orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode("utf-8")
+    except Exception:
+        s = str(obj)
+    if len(s) > max_len:
+        return s[:max_len] + "\n...[truncated]..."
+    return s
+
 
+# Единицы, для которых результат можно пересчитать пропорционально массе
+GRAM_UNITS = frozenset({"gram", "grams", "g", "грамм"})
+# Подходящие единицы из measures Edamam для штучных единиц, по приоритету (как в NUTRIENT_PROMPT)
+MEASURE_LABELS_BY_UNIT = {
+    "pieces": ("Whole", "Serving", "Unit"),
+    "штук": ("Whole", "Serving", "Unit"),
+    "piece": ("Piece", "Serving"),
+    "кусок": ("Piece", "Serving"),
+    "slice": ("Slice",),
+    "ломтик": ("Slice",),
+    "cup": ("Cup",),
+    "чашка": ("Cup",),
+}
+NUTRIENT_FIELDS = ("calories", "protein", "fat", "carbohydrates", "fiber")
+
+
+class NutrientCache:
+    """Двухуровневый кэш результатов analyze_dish_nutrients.
+
+    1. Точное совпадение по (нормализованное блюдо, количество, единица) — LRU в памяти.
+    2. Семантический поиск: для блюд в граммах хранятся значения на 100 г и эмбеддинг
+       названия; похожее блюдо (косинусная близость выше порога) пересчитывается на нужную
+       массу локально, без запросов к Edamam и LLM.
+
+    Эмбеддинги хранятся нормированными (float32) и собираются в одну матрицу, поэтому поиск
+    похожего блюда — одно матричное умножение, а не перебор векторов в Python.
+
+    Оба уровня ограничены max_entries. При указании path содержимое сохраняется в SQLite
+    (WAL, безопасно для нескольких процессов uvicorn) и переживает перезапуск.
+    """
+
+    def __init__(self, path: str | None = None, max_entries: int = 1024,
+                 embeddings: OpenAIEmbeddings | None = None, similarity_threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self._exact: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self._semantic: OrderedDict[str, tuple[np.ndarray, Dict[str, float]]] = OrderedDict()
+        # Матрица эмбеддингов семантического уровня (строки в порядке _matrix_names);
+        # пересобирается лениво после изменения _semantic
+        self._matrix: np.ndarray | None = None
+        self._matrix_names: List[str] = []
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.db_path = Path(path).expanduser() if path else None
+        if self.db_path is not None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS nutrient_cache ("
+                    "tier TEXT NOT NULL, key TEXT NOT NULL, value_json TEXT NOT NULL, "
+                    "updated_at REAL NOT NULL, PRIMARY KEY (tier, key))"
+                )
+                # Загружаем только самые свежие max_entries записей каждого уровня
+                for tier, target in (("exact", self._exact), ("semantic", self._semantic)):
+                    # Записи сверх лимита (например, добавленные другими процессами) удаляем
+                    conn.execute(
+                        "DELETE FROM nutrient_cache WHERE tier = ? AND key NOT IN ("
+                        "SELECT key FROM nutrient_cache WHERE tier = ? ORDER BY updated_at DESC LIMIT ?)",
+                        (tier, tier, max_entries),
+                    )
+                    rows = conn.execute(
+                        "SELECT key, value_json FROM nutrient_cache WHERE tier = ? "
+                        "ORDER BY updated_at DESC LIMIT ?",
+                        (tier, max_entries),
+                    ).fetchall()
+                    for key, value_json in reversed(rows):
+                        value = orjson.loads(value_json)
+                        if tier == "semantic":
+                            value = (self._unit_vector(value[0]), value[1])
+                        target[key] = value
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(str(self.db_path), timeout=30)
+
+    @staticmethod
+    def _normalize(dish: str) -> str:
+        # NFKC + casefold: полноширинные символы, лигатуры и регистр не дают разных ключей
+        return " ".join(unicodedata.normalize("NFKC", dish).casefold().split())
+
+    @classmethod
+    def _exact_key(cls, dish: str, amount: float, unit: str) -> str:
+        return f"{cls._normalize(dish)}|{round(float(amount), 1)}|{unit.strip().lower()}"
+
+    @staticmethod
+    def _unit_vector(vector: Any) -> np.ndarray:
+        # Для нормированных векторов косинусная близость равна скалярному произведению
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _semantic_matrix(self) -> tuple[List[str], np.ndarray | None]:
+        """Матрица эмбеддингов семантического уровня; вызывается под локом."""
+        if self._matrix is None and self._semantic:
+            self._matrix_names = list(self._semantic)
+            self._matrix = np.stack([vector for vector, _ in self._semantic.values()])
+        return self._matrix_names, self._matrix
+
+    def _uses_semantic(self, unit: str) -> bool:
+        return self.embeddings is not None and unit.strip().lower() in GRAM_UNITS
+
+    def lookup(self, dish: str, amount: float, unit: str) -> tuple[Dict[str, Any] | None, np.ndarray | None]:
+        """Ищет результат в кэше.
+
+        Returns:
+            (результат или None, эмбеддинг названия блюда, если он вычислялся). Эмбеддинг
+            нужно передать в set после расчета, чтобы не запрашивать его повторно.
+        """
+        key = self._exact_key(dish, amount, unit)
+        with self._lock:
+            if key in self._exact:
+                self._exact.move_to_end(key)
+                self.exact_hits += 1
+                return dict(self._exact[key]), None
+            names, matrix = self._semantic_matrix() if self._uses_semantic(unit) else ([], None)
+            if matrix is None:
+                self.misses += 1
+                return None, None
+
+        vector = self._unit_vector(self.embeddings.embed_query(self._normalize(dish)))
+        # Умножение идет по снимку матрицы без удержания лока (set создает новую матрицу)
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        best_name = names[best]
+        with self._lock:
+            entry = self._semantic.get(best_name)
+            if entry is None or scores[best] < self.similarity_threshold:
+                self.misses += 1
+                return None, vector
+            self.semantic_hits += 1
+            self._semantic.move_to_end(best_name)
+        best_per_100g = entry[1]
+        result: Dict[str, Any] = {"dish_name": f"{dish} ({amount} {unit})"}
+        for field in NUTRIENT_FIELDS:
+            result[field] = round(best_per_100g.get(field, 0.0) * float(amount) / 100, 1)
+        return result, vector
+
+    def get(self, dish: str, amount: float, unit: str) -> Dict[str, Any] | None:
+        return self.lookup(dish, amount, unit)[0]
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики попаданий и промахов кэша с момента запуска."""
+        with self._lock:
             return {
-                "success": True,
-                "nutrients": nutrients
+                "entries": len(self._exact),
+                "semantic_entries": len(self._semantic),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
             }
 
+    @staticmethod
+    def _put(store: OrderedDict, key: str, value: Any, max_entries: int) -> List[str]:
+        """Кладет значение в LRU-словарь и возвращает вытесненные ключи."""
+        store[key] = value
+        store.move_to_end(key)
+        evicted = []
+        while len(store) > max_entries:
+            evicted.append(store.popitem(last=False)[0])
+        return evicted
+
+    def set(self, dish: str, amount: float, unit: str, nutrients: Dict[str, Any],
+            vector: np.ndarray | None = None) -> None:
+        """Сохраняет результат; vector — эмбеддинг, полученный в lookup (иначе запрашивается)."""
+        key = self._exact_key(dish, amount, unit)
+        name = self._normalize(dish)
+        semantic_entry = None
+        if self._uses_semantic(unit) and float(amount) > 0:
+            per_100g = {field: float(nutrients.get(field) or 0.0) * 100 / float(amount) for field in NUTRIENT_FIELDS}
+            if vector is None:
+                vector = self.embeddings.embed_query(name)
+            semantic_entry = (self._unit_vector(vector), per_100g)
+
+        with self._lock:
+            writes = [("exact", key, dict(nutrients))]
+            deletes = [("exact", old) for old in self._put(self._exact, key, dict(nutrients), self.max_entries)]
+            if semantic_entry is not None:
+                writes.append(("semantic", name, [semantic_entry[0].tolist(), semantic_entry[1]]))
+                deletes += [("semantic", old)
+                            for old in self._put(self._semantic, name, semantic_entry, self.max_entries)]
+                self._matrix = None
+        if self.db_path is None:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO nutrient_cache (tier, key, value_json, updated_at) VALUES (?, ?, ?, ?)",
+                [(tier, k, orjson.dumps(value).decode("utf-8"), now) for tier, k, value in writes],
+            )
+            conn.executemany("DELETE FROM nutrient_cache WHERE tier = ? AND key = ?", deletes)
+        conn.close()
+
+
+# Словарь для улучшения поисковых запросов в Edamam
+SEARCH_OPTIMIZATIONS = {
+    # Приготовленные блюда
+    "cooked oatmeal": "oatmeal cooked",
+    "oatmeal porridge": "oatmeal cooked",
+    "cooked oatmeal porridge": "oatmeal cooked",
+    "hard-boiled egg": "egg boiled",
+    "boiled egg": "egg boiled",
+    "soft-boiled egg": "egg boiled",
+    "fried egg": "egg fried",
+    "scrambled eggs": "egg scrambled",
+    "cooked rice": "rice cooked",
+    "cooked pasta": "pasta cooked",
+    "cooked buckwheat": "buckwheat cooked",
+    "cooked quinoa": "quinoa cooked",
+
+    # Исправления для популярных продуктов
+    "buckwheat porridge": "buckwheat cooked",
+    "rice porridge": "rice cooked",
+    "millet porridge": "millet cooked",
+    "pearl barley porridge": "barley cooked",
+
+    # Овощи
+    "fried potatoes": "potato fried",
+    "mashed potatoes": "potato mashed",
+    "boiled potatoes": "potato boiled",
+    "baked potato": "potato baked",
+
+    # Мясо и рыба
+    "grilled chicken": "chicken grilled",
+    "fried chicken": "chicken fried",
+    "baked fish": "fish baked",
+    "grilled fish": "fish grilled",
+
+    # Молочные продукты
+    "greek yogurt": "yogurt greek",
+    "cottage cheese": "cheese cottage",
+}
+SEARCH_OPTIMIZATIONS_RE = re.compile("|".join(re.escape(key) for key in SEARCH_OPTIMIZATIONS))
+
+# Слова, которые убираются из названия перед добавлением способа приготовления
+COOKED_WORDS_RE = re.compile(r"cooked | ?porridge")
+BOILED_WORDS_RE = re.compile(r"hard-boiled |boiled | boiled")
+FRIED_WORDS_RE = re.compile(r"fried | fried")
+
+
+class EdamamFoodSearcher:
+    """Анализатор питательных веществ через Edamam API и OpenAI."""
+
+    def __init__(self, app_id: str, app_key: str, base_url: str, timeout: int = 30, max_results: int = 2,
+                 model_name: str = "gpt-4o-mini", temperature: float = 0.5, max_tokens: int = 800,
+                 request_timeout: int = 45,
+                 debug_api_log: bool = False,
+                 debug_max_chars: int = 2000,
+                 cache_path: str | None = None,
+                 cache_max_entries: int = 1024,
+                 semantic_cache_threshold: float | None = 0.95,
+                 embedding_model: str = "text-embedding-3-small",
+                 max_concurrent: int = 8,
+                 edamam_cache_path: str | None = None,
+                 edamam_cache_ttl_seconds: int = 7 * 24 * 3600,
+                 edamam_memory_cache_size: int = 4096,
+                 edamam_memory_cache_ttl_seconds: int = 24 * 3600):
+        """
+        Инициализация анализатора.
+
+        Args:
+            app_id: ID приложения Edamam
+            app_key: Ключ приложения Edamam
+            base_url: Базовый URL API
+            timeout: Таймаут запроса к Edamam API в секундах
+            max_results: Максимальное количество результатов
+            model_name: Название модели OpenAI
+            temperature: Температура для генерации
+            max_tokens: Максимальное количество токенов
+            request_timeout: Таймаут запроса к OpenAI API в секундах
+            cache_path: Путь к файлу кэша результатов (None — кэш только в памяти)
+            cache_max_entries: Максимальное число точных записей в кэше
+            semantic_cache_threshold: Порог косинусной близости для семантического кэша
+                (None — семантический уровень отключен)
+            embedding_model: Модель эмбеддингов для семантического кэша
+            max_concurrent: Максимальное число одновременных запросов (analyze_dishes_async и пул потоков синхронных методов)
+            edamam_cache_path: Путь к SQLite-файлу кэша ответов Edamam (None — без кэша)
+            edamam_cache_ttl_seconds: Время жизни записи кэша Edamam в секундах
+            edamam_memory_cache_size: Размер кэша ответов Edamam в памяти процесса (0 — без него)
+            edamam_memory_cache_ttl_seconds: Время жизни записи кэша Edamam в памяти в секундах
+        """
+        self.app_id = app_id
+        self.app_key = app_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_results = max_results
+        self.debug_api_log = debug_api_log
+        self.debug_max_chars = debug_max_chars
+        self.max_concurrent = max_concurrent
+        # Общий пул потоков синхронных методов (search_dishes, analyze_dishes) вместо пула на каждый вызов
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="edamam")
+        self.edamam_cache = AnalysisCache(edamam_cache_path, edamam_cache_ttl_seconds) if edamam_cache_path else None
+        # Быстрый уровень перед SQLite: повторные блюда не обращаются ни к диску, ни к API
+        self.edamam_memory_cache = (
+            TTLMemoryCache(edamam_memory_cache_size, edamam_memory_cache_ttl_seconds)
+            if edamam_memory_cache_size > 0 else None
+        )
+
+        # Пул keep-alive соединений к Edamam с повтором временных ошибок
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504)),
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        # httpx повторяет только ошибки установки соединения (статусы 5xx/429 не повторяются)
+        self._async_client = httpx.AsyncClient(
+            timeout=timeout,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=3,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+            ),
+        )
+
+        # OpenAI модель создается лениво (см. llm): расчет без LLM и кэш к ней не обращаются
+        self._llm_params = (model_name, temperature, max_tokens, request_timeout)
+        self.nutrient_prompt = NUTRIENT_PROMPT
+        # Статичные промпты передаются готовыми системными сообщениями, а не склеиваются
+        # с запросом на каждый вызов; одинаковый префикс также попадает в кэш промптов OpenAI
+        self._nutrient_system = SystemMessage(content=self.nutrient_prompt)
+        self._multiple_nutrient_system = SystemMessage(content=MULTIPLE_NUTRIENT_PROMPT)
+
+        embeddings = None
+        if semantic_cache_threshold is not None:
+            embeddings = OpenAIEmbeddings(
+                model=embedding_model,
+                http_client=get_shared_http_client(),
+                http_async_client=get_shared_async_http_client()
+            )
+        self.cache = NutrientCache(
+            path=cache_path,
+            max_entries=cache_max_entries,
+            embeddings=embeddings,
+            similarity_threshold=semantic_cache_threshold or 1.0,
+        )
+
+        self._build_chain()
+
+    async def aclose(self) -> None:
+        """Закрывает пулы соединений к Edamam, пул потоков синхронных методов и кэш Edamam."""
+        await self._async_client.aclose()
+        self._session.close()
+        self._executor.shutdown(wait=False)
+        if self.edamam_cache is not None:
+            self.edamam_cache.close()
+
+    @functools.cached_property
+    def llm(self) -> ChatOpenAI:
+        """OpenAI модель для анализа питательных веществ (создается при первом обращении)."""
+        return get_shared_llm(*self._llm_params)
+
+    @functools.cached_property
+    def nutrient_llm(self):
+        # Схема ответа передается в OpenAI (structured outputs) вместо инструкций формата в промпте
+        return self.llm.with_structured_output(NutrientAnalysis, method="json_schema", strict=True)
+
+    @functools.cached_property
+    def multiple_nutrient_llm(self):
+        return self.llm.with_structured_output(MultipleNutrientAnalysis, method="json_schema", strict=True)
+
+    def _optimize_search_term(self, dish_name: str) -> str:
+        """Оптимизирует поисковый термин для лучшего поиска в Edamam API."""
+        # Приводим к нижнему регистру для сравнения
+        dish_lower = dish_name.lower()
+
+        # Один проход регулярным выражением отсекает блюда без известных фраз;
+        # при совпадении порядок SEARCH_OPTIMIZATIONS определяет приоритет
+        if SEARCH_OPTIMIZATIONS_RE.search(dish_lower):
+            for dish_key, optimized_term in SEARCH_OPTIMIZATIONS.items():
+                if dish_key in dish_lower:
+                    return optimized_term
+
+        # Если точного совпадения нет, применяем общие правила
+        if "cooked" in dish_lower or "porridge" in dish_lower:
+            # Убираем слова "cooked" и "porridge" и добавляем "cooked" в конец
+            return f"{COOKED_WORDS_RE.sub('', dish_lower).strip()} cooked"
+
+        if "boiled" in dish_lower:
+            # Для вареных продуктов
+            return f"{BOILED_WORDS_RE.sub('', dish_lower).strip()} boiled"
+
+        if "fried" in dish_lower:
+            # Для жареных продуктов
+            return f"{FRIED_WORDS_RE.sub('', dish_lower).strip()} fried"
+
+        # Если никаких правил не применилось, возвращаем оригинальное название
+        return dish_name
+
+    def _prepare_search(self, dish_name: str) -> tuple[str, Dict[str, str]]:
+        """Возвращает оптимизированный поисковый термин и параметры запроса к Edamam."""
+        # Улучшаем поисковый запрос для лучшего поиска приготовленных блюд
+        search_term = self._optimize_search_term(dish_name)
+
+        # Логируем оптимизацию поиска если термин изменился
+        if search_term.lower() != dish_name.lower():
+            print(f"🔍 Поиск оптимизирован: '{dish_name}' → '{search_term}'")
+
+        params = {
+            "app_id": self.app_id,
+            "app_key": self.app_key,
+            "ingr": search_term,
+        }
+        return search_term, params
+
+    def _search_success(self, dish_name: str, search_term: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Обрезает ответ Edamam до max_results и формирует успешный результат поиска."""
+        if self.debug_api_log:
+            print("===== Edamam RAW response =====")
+            print(_safe_pretty(data, self.debug_max_chars))
+            print("===== /Edamam RAW response =====")
+
+        # Ограничиваем количество результатов и оставляем только нужные LLM поля
+        data = _slim_edamam(data, self.max_results)
+
+        # Логируем количество найденных результатов
+        parsed_count = len(data.get("parsed", []))
+        hints_count = len(data.get("hints", []))
+        print(f"📊 Edamam поиск '{search_term}': parsed={parsed_count}, hints={hints_count}")
+
+        return {
+            "dish_name": dish_name,
+            "search_term": search_term,
+            "success": True,
+            "data": data
+        }
+
+    @staticmethod
+    def _search_failure(dish_name: str, search_term: str, error: Exception) -> Dict[str, Any]:
+        print(f"❌ Ошибка поиска в Edamam для '{search_term}': {str(error)}")
+        return {
+            "dish_name": dish_name,
+            "search_term": search_term,
+            "success": False,
+            "error": str(error),
+            "data": None
+        }
+
+    def _edamam_cache_key(self, search_term: str) -> str:
+        return f"{search_term.lower()}|{self.max_results}"
+
+    def _search_cached(self, dish_name: str, search_term: str) -> Dict[str, Any] | None:
+        """Возвращает результат поиска из кэша Edamam (сначала в памяти, затем на диске), если он есть."""
+        key = self._edamam_cache_key(search_term)
+        data = self.edamam_memory_cache.get(key) if self.edamam_memory_cache is not None else None
+        if data is None and self.edamam_cache is not None:
+            data = self.edamam_cache.get(key)
+            if data is not None and self.edamam_memory_cache is not None:
+                self.edamam_memory_cache.set(key, data)
+        if data is None:
+            return None
+        print(f"💾 Edamam из кэша: '{search_term}'")
+        return {
+            "dish_name": dish_name,
+            "search_term": search_term,
+            "success": True,
+            "data": data
+        }
+
+    def _search_store(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Сохраняет успешный результат поиска в кэш Edamam (ошибки не кэшируются)."""
+        if not result.get("success"):
+            return result
+        key = self._edamam_cache_key(result["search_term"])
+        if self.edamam_memory_cache is not None:
+            self.edamam_memory_cache.set(key, result["data"])
+        if self.edamam_cache is not None:
+            self.edamam_cache.set(key, result["data"])
+        return result
+
+    def _search_single_dish(self, dish_name: str) -> Dict[str, Any]:
+        """Поиск одного блюда в Edamam API."""
+        search_term, params = self._prepare_search(dish_name)
+        cached = self._search_cached(dish_name, search_term)
+        if cached is not None:
+            return cached
+        try:
+            response = self._session.get(self.base_url, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            return self._search_store(self._search_success(dish_name, search_term, orjson.loads(response.content)))
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            return self._search_failure(dish_name, search_term, e)
+
+    async def _search_single_dish_async(self, dish_name: str) -> Dict[str, Any]:
+        """Асинхронный поиск одного блюда в Edamam API."""
+        search_term, params = self._prepare_search(dish_name)
+        cached = await asyncio.to_thread(self._search_cached, dish_name, search_term)
+        if cached is not None:
+            return cached
+        try:
+            response = await self._async_client.get(self.base_url, params=params)
+            response.raise_for_status()
+            result = self._search_success(dish_name, search_term, orjson.loads(response.content))
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+            return self._search_failure(dish_name, search_term, e)
+        return await asyncio.to_thread(self._search_store, result)
+
+    def search_dishes(self, dish_names: List[str]) -> List[Dict[str, Any]]:
+        """Параллельно (в пуле потоков) ищет несколько блюд в Edamam API; результаты в порядке входного списка."""
+        if len(dish_names) <= 1:
+            return [self._search_single_dish(name) for name in dish_names]
+        return list(self._executor.map(self._search_single_dish, dish_names))
+
+    async def search_dishes_async(self, dish_names: List[str]) -> List[Dict[str, Any]]:
+        """Параллельно ищет несколько блюд в Edamam API; результаты в порядке входного списка."""
+        return list(await asyncio.gather(*(self._search_single_dish_async(name) for name in dish_names)))
+
+    def _nutrient_messages(self, edamam_data: Dict[str, Any], dish: str, amount: float, unit: str,
+                           search_term: str = None) -> List[SystemMessage | HumanMessage]:
+        """Формирует сообщение к LLM для расчета нутриентов одного блюда."""
+        # Формируем полное название блюда с количеством
+        dish_with_amount = f"{dish} ({amount} {unit})"
+
+        # Формируем запрос для LLM
+        user_query = f"""
+            Блюдо: {dish}
+            Количество: {amount} {unit}
+            Поисковый термин в Edamam: {search_term or dish}
+
+            Данные от Edamam API:
+            {_compact_json(edamam_data)}
+
+            Проанализируй и рассчитай питательную ценность для указанного количества блюда.
+            ОБЯЗАТЕЛЬНО выбери продукт правильного состояния (приготовленный/сырой) основываясь на поисковом термине.
+            В поле dish_name укажи: "{dish_with_amount}"
+            """
+
+        return [
+            self._nutrient_system,
+            HumanMessage(content=user_query)
+        ]
+
+    def _parse_nutrient_response(self, response: NutrientAnalysis) -> Dict[str, Any]:
+        nutrients = response.model_dump()
+        if self.debug_api_log:
+            print("===== LLM response (single) =====")
+            print(_safe_pretty(nutrients, self.debug_max_chars))
+            print("===== /LLM response (single) =====")
+        return {
+            "success": True,
+            "nutrients": nutrients
+        }
+
+    @staticmethod
+    def _nutrient_failure(error: Exception) -> Dict[str, Any]:
+        return {
+            "success": False,
+            "error": f"Ошибка анализа питательных веществ: {str(error)}",
+            "nutrients": None
+        }
+
+    @staticmethod
+    def _measure_weight(food: Dict[str, Any], unit: str) -> float | None:
+        """Вес одной единицы (штука, чашка, ломтик...) в граммах по measures Edamam.
+
+        Берется стандартный вес единицы, а если он задан только с уточнениями — вариант "medium".
+        None, если подходящей единицы нет и выбор веса нужно оставить LLM.
+        """
+        measures = {measure.get("label"): measure for measure in food.get("measures") or []}
+        for label in MEASURE_LABELS_BY_UNIT.get(unit, ()):
+            measure = measures.get(label)
+            if measure is None:
+                continue
+            if measure.get("weight"):
+                return float(measure["weight"])
+            for qualified in measure.get("qualified") or []:
+                if "medium" in (qualified.get("qualifiers") or []) and qualified.get("weight"):
+                    return float(qualified["weight"])
+        return None
+
+    @classmethod
+    def _nutrient_fast_path(cls, edamam_data: Dict[str, Any], dish: str, amount: float, unit: str) -> Dict[str, Any] | None:
+        """Расчет нутриентов без LLM для однозначного случая.
+
+        Если Edamam вернул единственный продукт (одно совпадение в parsed или, без parsed,
+        одна подсказка в hints), а количество задано в граммах или в единице с известным
+        весом в measures, нутриенты на 100 г просто масштабируются. Иначе возвращается None.
+        """
+        candidates = edamam_data.get("parsed") or edamam_data.get("hints") or []
+        if len(candidates) != 1:
+            return None
+        food = candidates[0]
+        per_100g = food.get("nutrients") or {}
+        if "ENERC_KCAL" not in per_100g:
+            return None
+        normalized_unit = unit.strip().lower()
+        if normalized_unit in GRAM_UNITS:
+            grams = float(amount)
+        else:
+            weight = cls._measure_weight(food, normalized_unit)
+            if weight is None:
+                return None
+            grams = float(amount) * weight
+        factor = grams / 100
+        values = [round(float(per_100g.get(key) or 0.0) * factor, 1) for key in EDAMAM_NUTRIENT_KEYS]
+        return {
+            "success": True,
+            "nutrients": {"dish_name": f"{dish} ({amount} {unit})", **dict(zip(NUTRIENT_FIELDS, values))}
+        }
+
+    def _analyze_nutrients_with_llm(self, edamam_data: Dict[str, Any], dish: str, amount: float, unit: str, search_term: str = None) -> Dict[str, Any]:
+        """Анализ питательных веществ через OpenAI на основе данных Edamam."""
+        fast = self._nutrient_fast_path(edamam_data, dish, amount, unit)
+        if fast is not None:
+            print(f"⚡ Нутриенты рассчитаны без LLM: '{dish}' ({amount} {unit})")
+            return fast
+        try:
+            response = self.nutrient_llm.invoke(self._nutrient_messages(edamam_data, dish, amount, unit, search_term))
+            return self._parse_nutrient_response(response)
         except Exception as e:
-            return {
-                "success": False,
-                "error": f"Ошибка анализа питательных веществ: {str(e)}",
-                "nutrients": None
-            }
+            return self._nutrient_failure(e)
+
+    async def _analyze_nutrients_with_llm_async(self, edamam_data: Dict[str, Any], dish: str, amount: float, unit: str,
+                                                search_term: str = None) -> Dict[str, Any]:
+        """Асинхронный анализ питательных веществ через OpenAI на основе данных Edamam."""
+        fast = self._nutrient_fast_path(edamam_data, dish, amount, unit)
+        if fast is not None:
+            print(f"⚡ Нутриенты рассчитаны без LLM: '{dish}' ({amount} {unit})")
+            return fast
+        try:
+            response = await self.nutrient_llm.ainvoke(self._nutrient_messages(edamam_data, dish, amount, unit, search_term))
+            return self._parse_nutrient_response(response)
+        except Exception as e:
+            return self._nutrient_failure(e)
 
-    def _build_chain(self):
-        """Строит цепочку для анализа питательных веществ блюда."""
+    def _multiple_nutrient_messages(self, edamam_data_list: List[Dict[str, Any]],
+                                    dishes_info: List[Dict[str, Any]]) -> List[SystemMessage | HumanMessage]:
+        """Формирует сообщение к LLM для расчета нутриентов нескольких блюд."""
+        # Формируем запрос для LLM с информацией о всех блюдах
+        user_query = f"""
+        Анализируй следующие блюда:
 
-        def analyze_dish_nutrients(inputs: Dict[str, Any]) -> Dict[str, Any]:
-            """Анализ питательных веществ блюда."""
-            dish = inputs.get("dish", "").strip()
-            amount = inputs.get("amount", 100)
-            unit = inputs.get("unit", "gram")
+        """
 
-            # Логируем параметры запроса
-            print(f"🥗 Анализ нутриентов: блюдо='{dish}', количество={amount}, единица='{unit}'")
+        for i, (dish_info, edamam_data) in enumerate(zip(dishes_info, edamam_data_list), 1):
+            dish = dish_info["dish"]
+            amount = dish_info["amount"]
+            unit = dish_info["unit"]
+            search_term = dish_info.get("search_term", dish)
 
-            if not dish:
-                return {
-                    "error": "Не указано блюдо для анализа"
-                }
+            user_query += f"""
+        Блюдо {i}:
+        Название: {dish}
+        Количество: {amount} {unit}
+        Поисковый термин в Edamam: {search_term}
 
-            # Сначала получаем данные от Edamam
-            edamam_result = self._search_single_dish(dish)
+        Данные от Edamam API для блюда {i}:
+        {_compact_json(edamam_data)}
 
-            if not edamam_result.get("success"):
-                return {
-                    "error": edamam_result.get("error", "Ошибка получения данных от Edamam API")
-                }
+        ---
+
+        """
+
+        user_query += """
+        Проанализируй и рассчитай питательную ценность для каждого блюда в указанном количестве.
+        ОБЯЗАТЕЛЬНО выбери продукт правильного состояния (приготовленный/сырой) основываясь на поисковом термине.
+        """
+
+        return [
+            self._multiple_nutrient_system,
+            HumanMessage(content=user_query)
+        ]
+
+    def _parse_multiple_nutrient_response(self, response: MultipleNutrientAnalysis) -> Dict[str, Any]:
+        nutrients = response.model_dump()
+        if self.debug_api_log:
+            print("===== LLM response (multiple) =====")
+            print(_safe_pretty(nutrients, self.debug_max_chars))
+            print("===== /LLM response (multiple) =====")
 
-                        # Затем анализируем питательные вещества через LLM
-            nutrients_result = self._analyze_nutrients_with_llm(
-                edamam_result["data"], dish, amount, unit, edamam_result.get("search_term")
+        return {
+            "success": True,
+            "nutrients": nutrients
+        }
+
+    @staticmethod
+    def _multiple_nutrient_failure(error: Exception) -> Dict[str, Any]:
+        return {
+            "success": False,
+            "error": f"Ошибка анализа питательных веществ: {str(error)}",
+            "nutrients": None
+        }
+
+    def _analyze_multiple_nutrients_with_llm(self, edamam_data_list: List[Dict[str, Any]], dishes_info: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Анализ питательных веществ множественных блюд через OpenAI на основе данных Edamam."""
+        try:
+            response = self.multiple_nutrient_llm.invoke(self._multiple_nutrient_messages(edamam_data_list, dishes_info))
+            return self._parse_multiple_nutrient_response(response)
+        except Exception as e:
+            return self._multiple_nutrient_failure(e)
+
+    async def _analyze_multiple_nutrients_with_llm_async(self, edamam_data_list: List[Dict[str, Any]],
+                                                         dishes_info: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Асинхронный анализ питательных веществ множественных блюд через OpenAI."""
+        try:
+            response = await self.multiple_nutrient_llm.ainvoke(
+                self._multiple_nutrient_messages(edamam_data_list, dishes_info)
             )
+            return self._parse_multiple_nutrient_response(response)
+        except Exception as e:
+            return self._multiple_nutrient_failure(e)
 
-            # Возвращаем только nutrients
-            if nutrients_result["success"]:
-                return nutrients_result["nutrients"]
-            else:
-                return {
-                    "error": edamam_result.get("error") or nutrients_result.get("error")
-                }
+    def _analyze_dish_uncached(self, dish: str, amount: float = 100, unit: str = "gram") -> Dict[str, Any]:
+        """Анализ питательных веществ блюда: поиск в Edamam и расчет (без кэша нутриентов)."""
+        dish = dish.strip()
+
+        # Логируем параметры запроса
+        print(f"🥗 Анализ нутриентов: блюдо='{dish}', количество={amount}, единица='{unit}'")
+
+        if not dish:
+            return {
+                "error": "Не указано блюдо для анализа"
+            }
+
+        # Сначала получаем данные от Edamam
+        edamam_result = self._search_single_dish(dish)
+
+        if not edamam_result.get("success"):
+            return {
+                "error": edamam_result.get("error", "Ошибка получения данных от Edamam API")
+            }
+
+        # Затем анализируем питательные вещества через LLM
+        nutrients_result = self._analyze_nutrients_with_llm(
+            edamam_result["data"], dish, amount, unit, edamam_result.get("search_term")
+        )
+
+        # Возвращаем только nutrients
+        if nutrients_result["success"]:
+            return nutrients_result["nutrients"]
+        else:
+            return {
+                "error": edamam_result.get("error") or nutrients_result.get("error")
+            }
 
-        self.chain = RunnableLambda(analyze_dish_nutrients)
+    def _build_chain(self):
+        """Строит цепочку для анализа питательных веществ блюда.
+
+        Цепочка сохранена для совместимости (LangServe и т.п.); analyze_dish_nutrients
+        вызывает _analyze_dish_uncached напрямую, без накладных расходов Runnable.
+        """
+        self.chain = RunnableLambda(
+            lambda inputs: self._analyze_dish_uncached(
+                inputs.get("dish", ""), inputs.get("amount", 100), inputs.get("unit", "gram")
+            )
+        )
 
     def analyze_dish_nutrients(self, dish: str, amount: float = 100, unit: str = "gram") -> Dict[str, Any]:
         """
@@ -712,29 +2045,189 @@ class EdamamFoodSearcher:
         Returns:
             Результат анализа питательных веществ
         """
-        return self.chain.invoke({"dish": dish, "amount": amount, "unit": unit})
+        try:
+            cached, vector = self.cache.lookup(dish, amount, unit)
+        except Exception as e:
+            print(f"⚠️ Ошибка чтения кэша нутриентов: {e}")
+            cached, vector = None, None
+        if cached is not None:
+            print(f"💾 Нутриенты из кэша: '{dish}' ({amount} {unit})")
+            return cached
+
+        result = self._analyze_dish_uncached(dish, amount, unit)
+        if "error" not in result:
+            try:
+                self.cache.set(dish, amount, unit, result, vector)
+            except Exception as e:
+                print(f"⚠️ Ошибка записи в кэш нутриентов: {e}")
+        return result
+
+    async def analyze_dish_nutrients_async(self, dish: str, amount: float = 100, unit: str = "gram") -> Dict[str, Any]:
+        """
+        Асинхронный анализ питательных веществ одного блюда.
 
-    def analyze_multiple_dishes_nutrients(self, dishes: List[MultipleDishItem]) -> Dict[str, Any]:
+        Поиск в Edamam и запрос к LLM не блокируют event loop, поэтому несколько блюд
+        можно анализировать одновременно через asyncio.gather (см. analyze_dishes_async).
+
+        Args:
+            dish: Название блюда
+            amount: Количество блюда
+            unit: Единица измерения (gram, pieces, cup, piece, slice)
+
+        Returns:
+            Результат в формате analyze_dish_nutrients
         """
-        Анализ питательных веществ множественных блюд.
+        dish = dish.strip()
+        print(f"🥗 Анализ нутриентов: блюдо='{dish}', количество={amount}, единица='{unit}'")
+        if not dish:
+            return {"error": "Не указано блюдо для анализа"}
+
+        try:
+            cached, vector = await asyncio.to_thread(self.cache.lookup, dish, amount, unit)
+        except Exception as e:
+            print(f"⚠️ Ошибка чтения кэша нутриентов: {e}")
+            cached, vector = None, None
+        if cached is not None:
+            print(f"💾 Нутриенты из кэша: '{dish}' ({amount} {unit})")
+            return cached
+
+        edamam_result = await self._search_single_dish_async(dish)
+        if not edamam_result.get("success"):
+            return {"error": edamam_result.get("error", "Ошибка получения данных от Edamam API")}
+
+        nutrients_result = await self._analyze_nutrients_with_llm_async(
+            edamam_result["data"], dish, amount, unit, edamam_result.get("search_term")
+        )
+        if not nutrients_result["success"]:
+            return {"error": nutrients_result.get("error")}
+        try:
+            await asyncio.to_thread(self.cache.set, dish, amount, unit, nutrients_result["nutrients"], vector)
+        except Exception as e:
+            print(f"⚠️ Ошибка записи в кэш нутриентов: {e}")
+        return nutrients_result["nutrients"]
+
+    async def analyze_dishes_async(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Параллельный анализ питательных веществ нескольких блюд (по одному запросу к LLM на блюдо).
+
+        Сначала параллельно выполняются поиски в Edamam, затем параллельные запросы к LLM.
+        Число одновременных запросов ограничено max_concurrent. Одинаковые блюда
+        (название, количество, единица) анализируются один раз.
 
         Args:
-            dishes: Список блюд для анализа
+            items: Список словарей с ключами dish, amount, unit
 
         Returns:
-            Результат анализа питательных веществ для всех блюд
+            Список результатов в формате analyze_dish_nutrients, в порядке входного списка
         """
-        if not dishes:
-            return {"error": "Не указаны блюда для анализа"}
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        dishes = [(str(item.get("dish", "")).strip(), item.get("amount", 100), item.get("unit", "gram"))
+                  for item in items]
+        results: List[Dict[str, Any] | None] = [None] * len(dishes)
+        unique: List[int] = []
+        # Повторы внутри запроса: индекс первого вхождения -> индексы повторов
+        duplicates: Dict[int, List[int]] = {}
+        first_by_key: Dict[str, int] = {}
+        for i, (dish, amount, unit) in enumerate(dishes):
+            if not dish:
+                results[i] = {"error": "Не указано блюдо для анализа"}
+                continue
+            key = self.cache._exact_key(dish, amount, unit)
+            if key in first_by_key:
+                duplicates.setdefault(first_by_key[key], []).append(i)
+                continue
+            first_by_key[key] = i
+            unique.append(i)
+
+        async def lookup(i: int) -> tuple[Dict[str, Any] | None, np.ndarray | None]:
+            # Промах семантического уровня запрашивает эмбеддинг: ошибка кэша считается промахом
+            try:
+                async with semaphore:
+                    return await asyncio.to_thread(self.cache.lookup, *dishes[i])
+            except Exception as e:
+                print(f"⚠️ Ошибка чтения кэша нутриентов: {e}")
+                return None, None
+
+        vectors: Dict[int, np.ndarray | None] = {}
+        pending = []
+        for i, (cached, vectors[i]) in zip(unique, await asyncio.gather(*(lookup(i) for i in unique))):
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.append(i)
 
-        print(f"🥗 Анализ множественных нутриентов: {len(dishes)} блюд")
+        async def search(i: int) -> Dict[str, Any]:
+            async with semaphore:
+                return await self._search_single_dish_async(dishes[i][0])
 
-        # Шаг 1: Получаем данные от Edamam для каждого блюда (раздельные запросы)
+        async def analyze(i: int, edamam_result: Dict[str, Any]) -> Dict[str, Any]:
+            if not edamam_result.get("success"):
+                return {"error": edamam_result.get("error", "Ошибка получения данных от Edamam API")}
+            dish, amount, unit = dishes[i]
+            async with semaphore:
+                nutrients_result = await self._analyze_nutrients_with_llm_async(
+                    edamam_result["data"], dish, amount, unit, edamam_result.get("search_term")
+                )
+            if not nutrients_result["success"]:
+                return {"error": nutrients_result.get("error")}
+            try:
+                await asyncio.to_thread(self.cache.set, dish, amount, unit, nutrients_result["nutrients"], vectors[i])
+            except Exception as e:
+                print(f"⚠️ Ошибка записи в кэш нутриентов: {e}")
+            return nutrients_result["nutrients"]
+
+        edamam_results = await asyncio.gather(*(search(i) for i in pending))
+        analyzed = await asyncio.gather(*(analyze(i, r) for i, r in zip(pending, edamam_results)),
+                                        return_exceptions=True)
+        for i, result in zip(pending, analyzed):
+            results[i] = {"error": str(result)} if isinstance(result, Exception) else result
+        for i, repeats in duplicates.items():
+            for j in repeats:
+                results[j] = dict(results[i])
+        return results
+
+    def analyze_dishes(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Синхронный параллельный анализ питательных веществ нескольких блюд.
+
+        Блюда анализируются в пуле потоков (не более max_concurrent одновременно) через
+        синхронные клиенты: асинхронные клиенты привязаны к event loop сервера, поэтому
+        здесь не используются. Одинаковые блюда анализируются один раз.
+
+        Args:
+            items: Список словарей с ключами dish, amount, unit
+
+        Returns:
+            Список результатов в формате analyze_dish_nutrients, в порядке входного списка
+        """
+        dishes = [(str(item.get("dish", "")).strip(), item.get("amount", 100), item.get("unit", "gram"))
+                  for item in items]
+        unique: Dict[str, tuple[str, Any, str]] = {}
+        for dish, amount, unit in dishes:
+            unique.setdefault(self.cache._exact_key(dish, amount, unit), (dish, amount, unit))
+
+        def analyze(args: tuple[str, Any, str]) -> Dict[str, Any]:
+            try:
+                return self.analyze_dish_nutrients(*args)
+            except Exception as e:
+                return {"error": str(e)}
+
+        if len(unique) <= 1:
+            results = [analyze(args) for args in unique.values()]
+        else:
+            results = list(self._executor.map(analyze, unique.values()))
+        by_key = dict(zip(unique, results))
+        return [dict(by_key[self.cache._exact_key(dish, amount, unit)]) for dish, amount, unit in dishes]
+
+    @staticmethod
+    def _collect_edamam_results(names: List[str], dishes: List[MultipleDishItem],
+                                found: List[Dict[str, Any]]) -> tuple[List[Dict[str, Any] | None], List[Dict[str, Any]]]:
+        """Сопоставляет результаты поиска в Edamam с входными блюдами (пустые названия — ошибка)."""
         edamam_data_list = []
         dishes_info = []
+        found_iter = iter(found)
 
-        for dish_item in dishes:
-            dish = dish_item.dish.strip()
+        for dish, dish_item in zip(names, dishes):
             amount = dish_item.amount
             unit = dish_item.unit
 
@@ -748,10 +2241,7 @@ class EdamamFoodSearcher:
                 })
                 continue
 
-            print(f"🔍 Поиск в Edamam: '{dish}' ({amount} {unit})")
-
-            # Получаем данные от Edamam для этого блюда
-            edamam_result = self._search_single_dish(dish)
+            edamam_result = next(found_iter)
 
             if edamam_result.get("success"):
                 edamam_data_list.append(edamam_result["data"])
@@ -770,82 +2260,145 @@ class EdamamFoodSearcher:
                     "error": edamam_result.get("error", "Ошибка поиска в Edamam")
                 })
 
-        # Проверяем, есть ли успешные результаты
-        successful_dishes = [(data, info) for data, info in zip(edamam_data_list, dishes_info)
-                           if data is not None and "error" not in info]
+        return edamam_data_list, dishes_info
 
-        if not successful_dishes:
+    @staticmethod
+    def _combine_multiple_results(dishes: List[MultipleDishItem], dishes_info: List[Dict[str, Any]],
+                                  successful_count: int, nutrients_result: Dict[str, Any]) -> Dict[str, Any]:
+        """Объединяет ответ LLM с ошибками поиска в итоговый результат в порядке входных блюд."""
+        if not nutrients_result["success"]:
             return {
-                "error": "Не удалось найти данные ни для одного блюда",
+                "error": nutrients_result.get("error", "Ошибка анализа питательных веществ"),
                 "details": dishes_info
             }
 
-        # Шаг 2: Отправляем один запрос к LLM со всеми успешными данными
-        successful_edamam_data = [item[0] for item in successful_dishes]
-        successful_dishes_info = [item[1] for item in successful_dishes]
+        final_results = []
+
+        # Результат structured output уже преобразован в словарь через model_dump()
+        successful_results = nutrients_result["nutrients"]["dishes"]
+        success_idx = 0
+
+        for dish_info in dishes_info:
+            if "error" in dish_info:
+                # Добавляем ошибку
+                final_results.append({
+                    "dish_name": f"{dish_info['dish']} ({dish_info['amount']} {dish_info['unit']})",
+                    "error": dish_info["error"],
+                    "calories": 0.0,
+                    "protein": 0.0,
+                    "fat": 0.0,
+                    "carbohydrates": 0.0,
+                    "fiber": 0.0
+                })
+            elif success_idx < len(successful_results):
+                # Добавляем успешный результат
+                result = successful_results[success_idx]
+                final_results.append({
+                    "dish_name": result.get("dish_name", ""),
+                    "calories": result.get("calories", 0.0),
+                    "protein": result.get("protein", 0.0),
+                    "fat": result.get("fat", 0.0),
+                    "carbohydrates": result.get("carbohydrates", 0.0),
+                    "fiber": result.get("fiber", 0.0)
+                })
+                success_idx += 1
 
-        print(f"📊 Отправляем в LLM данные о {len(successful_dishes)} блюдах")
+        return {
+            "dishes": final_results,
+            "total_dishes": len(dishes),
+            "successful_dishes": successful_count,
+            "failed_dishes": len(dishes) - successful_count
+        }
 
-        nutrients_result = self._analyze_multiple_nutrients_with_llm(
-            successful_edamam_data, successful_dishes_info
-        )
+    def _start_multiple(self, dishes: List[MultipleDishItem]) -> List[str]:
+        print(f"🥗 Анализ множественных нутриентов: {len(dishes)} блюд")
+        names = [dish_item.dish.strip() for dish_item in dishes]
+        for name, dish_item in zip(names, dishes):
+            if name:
+                print(f"🔍 Поиск в Edamam: '{name}' ({dish_item.amount} {dish_item.unit})")
+        return names
+
+    @staticmethod
+    def _successful_dishes(edamam_data_list: List[Dict[str, Any] | None],
+                           dishes_info: List[Dict[str, Any]]) -> tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        successful = [(data, info) for data, info in zip(edamam_data_list, dishes_info)
+                      if data is not None and "error" not in info]
+        return [item[0] for item in successful], [item[1] for item in successful]
 
-        if nutrients_result["success"]:
-            # Объединяем результаты с ошибками (если есть)
-            final_results = []
-
-            # Создаем индекс успешных блюд
-            # JsonOutputParser возвращает словарь, а не объект Pydantic
-            successful_results = nutrients_result["nutrients"]["dishes"]
-            success_idx = 0
-
-            for i, dish_info in enumerate(dishes_info):
-                if "error" in dish_info:
-                    # Добавляем ошибку
-                    final_results.append({
-                        "dish_name": f"{dish_info['dish']} ({dish_info['amount']} {dish_info['unit']})",
-                        "error": dish_info["error"],
-                        "calories": 0.0,
-                        "protein": 0.0,
-                        "fat": 0.0,
-                        "carbohydrates": 0.0,
-                        "fiber": 0.0
-                    })
-                else:
-                    # Добавляем успешный результат
-                    if success_idx < len(successful_results):
-                        result = successful_results[success_idx]
-                        final_results.append({
-                            "dish_name": result.get("dish_name", ""),
-                            "calories": result.get("calories", 0.0),
-                            "protein": result.get("protein", 0.0),
-                            "fat": result.get("fat", 0.0),
-                            "carbohydrates": result.get("carbohydrates", 0.0),
-                            "fiber": result.get("fiber", 0.0)
-                        })
-                        success_idx += 1
+    def analyze_multiple_dishes_nutrients(self, dishes: List[MultipleDishItem]) -> Dict[str, Any]:
+        """
+        Анализ питательных веществ множественных блюд.
 
+        Args:
+            dishes: Список блюд для анализа
+
+        Returns:
+            Результат анализа питательных веществ для всех блюд
+        """
+        if not dishes:
+            return {"error": "Не указаны блюда для анализа"}
+
+        # Шаг 1: Получаем данные от Edamam для каждого блюда (раздельные запросы выполняются параллельно)
+        names = self._start_multiple(dishes)
+        found = self.search_dishes([name for name in names if name])
+        edamam_data_list, dishes_info = self._collect_edamam_results(names, dishes, found)
+
+        successful_edamam_data, successful_dishes_info = self._successful_dishes(edamam_data_list, dishes_info)
+        if not successful_edamam_data:
             return {
-                "dishes": final_results,
-                "total_dishes": len(dishes),
-                "successful_dishes": len(successful_dishes),
-                "failed_dishes": len(dishes) - len(successful_dishes)
+                "error": "Не удалось найти данные ни для одного блюда",
+                "details": dishes_info
             }
-        else:
+
+        # Шаг 2: Отправляем один запрос к LLM со всеми успешными данными
+        print(f"📊 Отправляем в LLM данные о {len(successful_edamam_data)} блюдах")
+        nutrients_result = self._analyze_multiple_nutrients_with_llm(successful_edamam_data, successful_dishes_info)
+        return self._combine_multiple_results(dishes, dishes_info, len(successful_edamam_data), nutrients_result)
+
+    async def analyze_multiple_dishes_nutrients_async(self, dishes: List[MultipleDishItem]) -> Dict[str, Any]:
+        """
+        Асинхронный вариант analyze_multiple_dishes_nutrients.
+
+        Поиски в Edamam и запрос к LLM выполняются через асинхронные клиенты и не
+        блокируют event loop.
+
+        Args:
+            dishes: Список блюд для анализа
+
+        Returns:
+            Результат анализа питательных веществ для всех блюд
+        """
+        if not dishes:
+            return {"error": "Не указаны блюда для анализа"}
+
+        names = self._start_multiple(dishes)
+        found = await self.search_dishes_async([name for name in names if name])
+        edamam_data_list, dishes_info = self._collect_edamam_results(names, dishes, found)
+
+        successful_edamam_data, successful_dishes_info = self._successful_dishes(edamam_data_list, dishes_info)
+        if not successful_edamam_data:
             return {
-                "error": nutrients_result.get("error", "Ошибка анализа питательных веществ"),
+                "error": "Не удалось найти данные ни для одного блюда",
                 "details": dishes_info
             }
 
+        print(f"📊 Отправляем в LLM данные о {len(successful_edamam_data)} блюдах")
+        nutrients_result = await self._analyze_multiple_nutrients_with_llm_async(
+            successful_edamam_data, successful_dishes_info
+        )
+        return self._combine_multiple_results(dishes, dishes_info, len(successful_edamam_data), nutrients_result)
+
 
+@functools.lru_cache(maxsize=1)
 def create_food_analyzer() -> FoodImageAnalyzer:
-    """Создает экземпляр анализатора изображений еды."""
+    """Возвращает общий экземпляр анализатора изображений еды (создается один раз)."""
     return FoodImageAnalyzer()
 
 
-def create_food_searcher(app_id: str, app_key: str, base_url: str, timeout: int = 30, max_results: int = 10,
-                        model_name: str = "gpt-4o", temperature: float = 0.5, max_tokens: int = 800,
+@functools.lru_cache(maxsize=8)
+def create_food_searcher(app_id: str, app_key: str, base_url: str, timeout: int = 30, max_results: int = 2,
+                        model_name: str = "gpt-4o-mini", temperature: float = 0.5, max_tokens: int = 800,
                         request_timeout: int = 45) -> EdamamFoodSearcher:
-    """Создает экземпляр анализатора питательных веществ."""
+    """Возвращает общий экземпляр анализатора питательных веществ для заданных параметров."""
     return EdamamFoodSearcher(app_id, app_key, base_url, timeout, max_results, model_name, temperature,
                              max_tokens, request_timeout)
\ No newline at end of file
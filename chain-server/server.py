@@ -9,7 +9,9 @@ LangServe сервер для анализа изображений еды и р
 """
 
 import os
-import base64
+import binascii
+import functools
+import pybase64
 import yaml
 import logging
 import time
@@ -17,20 +19,33 @@ from typing import Dict, Any
 from pathlib import Path
 from contextlib import asynccontextmanager
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
 import sqlite3
-import json
+import threading
+import tempfile
+import orjson
 from urllib.request import urlopen
 from urllib.error import URLError, HTTPError
+from urllib.parse import urlparse
 
 from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uuid
 
+# C-реализация загрузчика (LibYAML) в разы быстрее; если PyYAML собран без нее — чистый Python
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 from food_analyzer import (FoodImageAnalyzer, EdamamFoodSearcher, FoodSearchRequest, NutrientAnalysis,
-                          MultipleDishesRequest, MultipleDishItem, MultipleNutrientAnalysis)
+                          MultipleDishesRequest, MultipleDishItem, MultipleNutrientAnalysis,
+                          close_shared_http_clients, create_image_process_pool)
 
 
 # Константы для настроек
@@ -42,11 +57,18 @@ CORS_SETTINGS = {
 }
 
 FILES_SETTINGS = {
-    "temp_dir": "temp_images",
     "allowed_extensions": [".jpg", ".jpeg", ".png", ".gif", ".webp"],
     "max_file_size_mb": 16,
+    # Передавать image_url в OpenAI ссылкой, без скачивания и base64 (URL должен быть публичным)
+    "pass_image_urls": True,
 }
 
+# Значения, читаемые на каждом запросе, вычисляются один раз при импорте
+PASS_IMAGE_URLS = bool(FILES_SETTINGS["pass_image_urls"])
+MAX_IMAGE_BYTES = FILES_SETTINGS["max_file_size_mb"] * 1024 * 1024
+# base64 увеличивает размер в 4/3 раза; запас на префикс data:image/...;base64,
+MAX_BASE64_LENGTH = MAX_IMAGE_BYTES * 4 // 3 + 256
+
 ANALYSIS_SETTINGS = {
     "confidence_threshold": 0.0,
     "default_language": "ru",
@@ -59,16 +81,33 @@ ANALYSIS_SETTINGS = {
 JOBS_DB_PATH = Path("jobs.sqlite3")
 
 
-def _db_connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(str(JOBS_DB_PATH))
+# Одно соединение на процесс: без повторного открытия файла и разбора схемы на каждый вызов.
+# WAL + synchronous=NORMAL убирают fsync на каждую запись; доступ из разных потоков — под локом
+_DB_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
+def _db_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(str(JOBS_DB_PATH), check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
 
+def close_db() -> None:
+    """Закрывает общее соединение с базой задач (при остановке сервера)."""
+    with _DB_LOCK:
+        if _db_connection.cache_info().currsize:
+            _db_connection().close()
+            _db_connection.cache_clear()
+
+
 def init_db() -> None:
     """Создает таблицу job при необходимости."""
-    with _db_connect() as conn:
-        conn.execute(
+    with _DB_LOCK:
+        _db_connection().execute(
             """
             CREATE TABLE IF NOT EXISTS job (
                 id TEXT PRIMARY KEY,
@@ -82,7 +121,6 @@ def init_db() -> None:
             )
             """
         )
-        conn.commit()
 
 
 def _utc_now_str() -> str:
@@ -92,104 +130,240 @@ def _utc_now_str() -> str:
 def insert_job(image_url: str | None, params: Dict[str, Any]) -> str:
     job_id = str(uuid.uuid4())
     now = _utc_now_str()
-    with _db_connect() as conn:
-        conn.execute(
+    with _DB_LOCK:
+        _db_connection().execute(
             "INSERT INTO job (id, status, created_at, updated_at, error, result_json, image_url, params_json)\n             VALUES (?, ?, ?, ?, NULL, NULL, ?, ?)",
-            (job_id, "queued", now, now, image_url, json.dumps(params, ensure_ascii=False)),
+            (job_id, "queued", now, now, image_url, orjson.dumps(params).decode("utf-8")),
         )
-        conn.commit()
     return job_id
 
 
 def update_job_status(job_id: str, status: str, error: str | None = None) -> None:
     now = _utc_now_str()
-    with _db_connect() as conn:
-        conn.execute(
+    with _DB_LOCK:
+        _db_connection().execute(
             "UPDATE job SET status = ?, updated_at = ?, error = ? WHERE id = ?",
             (status, now, error, job_id),
         )
-        conn.commit()
 
 
 def update_job_result(job_id: str, result: Dict[str, Any]) -> None:
     now = _utc_now_str()
-    with _db_connect() as conn:
-        conn.execute(
+    with _DB_LOCK:
+        _db_connection().execute(
             "UPDATE job SET status = ?, updated_at = ?, result_json = ? WHERE id = ?",
-            ("done", now, json.dumps(result, ensure_ascii=False), job_id),
+            ("done", now, orjson.dumps(result).decode("utf-8"), job_id),
         )
-        conn.commit()
 
 
 def get_job(job_id: str) -> Dict[str, Any] | None:
-    with _db_connect() as conn:
-        cur = conn.execute("SELECT * FROM job WHERE id = ?", (job_id,))
-        row = cur.fetchone()
-        if not row:
-            return None
-        return {k: row[k] for k in row.keys()}
+    with _DB_LOCK:
+        row = _db_connection().execute("SELECT * FROM job WHERE id = ?", (job_id,)).fetchone()
+    if not row:
+        return None
+    return {k: row[k] for k in row.keys()}
+
+
+def update_job_statuses(rows: list[tuple[str, str, str | None, str]]) -> None:
+    """Записывает пачку промежуточных статусов (status, updated_at, error, id) одной транзакцией.
+
+    Задачи, уже перешедшие в конечный статус, не перезаписываются: запись из очереди
+    может прийти позже прямой записи done/error.
+    """
+    with _DB_LOCK:
+        conn = _db_connection()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "UPDATE job SET status = ?, updated_at = ?, error = ? "
+                "WHERE id = ? AND status NOT IN ('done', 'error')",
+                rows,
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+# Промежуточные статусы (processing) копятся в очереди и пишутся пачками фоновой задачей,
+# конечные (done/error) пишутся сразу
+JOB_STATUS_FLUSH_INTERVAL = 0.02
+_status_queue: asyncio.Queue | None = None
+_status_flusher: asyncio.Task | None = None
+
+
+def _drain_status_queue(rows: list[tuple[str, str, str | None, str]]) -> bool:
+    """Забирает из очереди все накопленные статусы; True, если встретился сигнал остановки."""
+    stop = False
+    while not _status_queue.empty():
+        item = _status_queue.get_nowait()
+        if item is None:
+            stop = True
+        else:
+            rows.append(item)
+    return stop
+
+
+async def _write_job_statuses(rows: list[tuple[str, str, str | None, str]]) -> None:
+    if not rows:
+        return
+    try:
+        await asyncio.to_thread(update_job_statuses, rows)
+    except Exception as e:
+        api_logger.error("[JOB] Ошибка записи статусов задач: %s", e)
+
+
+async def _flush_job_statuses() -> None:
+    """Фоновая задача: собирает статусы за JOB_STATUS_FLUSH_INTERVAL и пишет их одной транзакцией.
+
+    Завершается по сигналу остановки (None в очереди), предварительно дописав накопленное.
+    """
+    while True:
+        item = await _status_queue.get()
+        stop = item is None
+        rows = [] if stop else [item]
+        if not stop:
+            await asyncio.sleep(JOB_STATUS_FLUSH_INTERVAL)
+        stop = _drain_status_queue(rows) or stop
+        await _write_job_statuses(rows)
+        if stop:
+            return
+
+
+def start_status_flusher() -> None:
+    global _status_queue, _status_flusher
+    _status_queue = asyncio.Queue()
+    _status_flusher = asyncio.create_task(_flush_job_statuses())
+
+
+async def stop_status_flusher() -> None:
+    """Останавливает фоновую запись и дописывает оставшиеся в очереди статусы."""
+    global _status_queue, _status_flusher
+    if _status_flusher is None:
+        return
+    # Не отменяем задачу: cancel во время sleep потерял бы уже собранную пачку
+    _status_queue.put_nowait(None)
+    await _status_flusher
+    rows: list[tuple[str, str, str | None, str]] = []
+    _drain_status_queue(rows)
+    await _write_job_statuses(rows)
+    _status_queue = None
+    _status_flusher = None
+
+
+async def queue_job_status(job_id: str, status: str, error: str | None = None) -> None:
+    """Ставит промежуточный статус в очередь фоновой записи (без фоновой задачи — пишет сразу)."""
+    if _status_queue is None:
+        await asyncio.to_thread(update_job_status, job_id, status, error)
+        return
+    _status_queue.put_nowait((status, _utc_now_str(), error, job_id))
 
 
 # ==========================
 # Общие вспомогательные функции анализа
 # ==========================
+UNIT_RU_TO_EN = {
+    "штук": "pieces",
+    "кусок": "piece",
+    "ломтик": "slice",
+    "чашка": "cup",
+    "грамм": "gram",
+}
+
+
 def unit_ru_to_en(unit_ru: str) -> str:
-    mapping = {
-        "штук": "pieces",
-        "кусок": "piece",
-        "ломтик": "slice",
-        "чашка": "cup",
-        "грамм": "gram",
-    }
-    return mapping.get(unit_ru.strip().lower(), "gram")
+    return UNIT_RU_TO_EN.get(unit_ru.strip().lower(), "gram")
 
 
-def _download_image(url: str, filename_hint: str | None = None) -> str:
-    """Скачивает изображение по URL во временную папку и возвращает локальный путь."""
-    temp_dir = Path(FILES_SETTINGS["temp_dir"])  # type: ignore[index]
-    temp_dir.mkdir(exist_ok=True)
-    safe_name = filename_hint or f"download_{uuid.uuid4().hex}.img"
-    temp_path = temp_dir / safe_name
+def _download_image(url: str) -> bytes:
+    """Скачивает изображение по URL и возвращает его содержимое."""
     try:
-        with urlopen(url) as resp, open(temp_path, "wb") as out:
-            out.write(resp.read())
+        with urlopen(url) as resp:
+            data = resp.read(MAX_IMAGE_BYTES + 1)
     except (URLError, HTTPError) as e:
         raise ValueError(f"Не удалось скачать изображение по URL: {e}")
-    return str(temp_path)
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ValueError(f"Изображение по URL больше {FILES_SETTINGS['max_file_size_mb']} МБ")
+    return data
+
+
+def _read_image_file(image_path: str) -> bytes:
+    """Читает локальное изображение целиком одним чтением (с проверкой размера)."""
+    path = Path(image_path)
+    try:
+        if path.stat().st_size > MAX_IMAGE_BYTES:
+            raise ValueError(f"Изображение больше {FILES_SETTINGS['max_file_size_mb']} МБ")
+        return path.read_bytes()
+    except OSError as e:
+        raise ValueError(f"Не удалось прочитать изображение {image_path}: {e}")
+
+
+def validate_image_request(image_base64: str | None, filename: str | None) -> None:
+    """Дешевые проверки запроса до постановки задачи: размер base64 и имя файла.
+
+    Размер проверяется по длине строки, до декодирования, поэтому слишком большие
+    изображения отклоняются без затрат памяти и CPU.
+    """
+    if image_base64 is not None and len(image_base64) > MAX_BASE64_LENGTH:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Изображение больше {FILES_SETTINGS['max_file_size_mb']} МБ"
+        )
+    if filename is not None and (Path(filename).name != filename or filename in ("", ".", "..")):
+        raise HTTPException(status_code=400, detail="Некорректное имя файла")
 
 
-def resolve_image_source(image_path: str | None, image_base64: str | None, filename: str | None, image_url: str | None) -> tuple[str, bool]:
-    """Возвращает локальный путь к изображению и флаг, что файл временный."""
+async def resolve_image_source(image_path: str | None, image_base64: str | None, image_url: str | None) -> str | bytes:
+    """Возвращает URL изображения или его содержимое в памяти.
+
+    Временные файлы не создаются: байты передаются анализатору напрямую. Локальный файл
+    читается один раз (хэш для кэша и кодирование считаются по этим байтам), чтение,
+    декодирование и скачивание выполняются в пуле потоков, не блокируя event loop.
+    """
     if image_path:
-        return image_path, False
+        if urlparse(image_path).scheme in ("http", "https"):
+            return image_path
+        return await asyncio.to_thread(_read_image_file, image_path)
     if image_base64:
-        if not filename:
-            raise HTTPException(status_code=400, detail="Для base64 изображения нужен filename")
-        return _save_base64_image(image_base64, filename), True
+        return await asyncio.to_thread(_decode_base64_image, image_base64)
     if image_url:
-        return _download_image(image_url, filename), True
+        if PASS_IMAGE_URLS:
+            return image_url
+        return await asyncio.to_thread(_download_image, image_url)
     raise HTTPException(status_code=400, detail="Укажите image_path, image_base64 или image_url")
 
 
-def compute_image_analysis_by_path(image_path: str) -> Dict[str, Any]:
+def _describe_image(image: str | bytes) -> str:
+    """Краткое описание источника изображения для логов."""
+    return f"<{len(image)} байт>" if isinstance(image, bytes) else image
+
+
+async def _analyze_image_source(image: str | bytes) -> Dict[str, Any]:
+    """Анализирует изображение по пути/URL или из памяти, не блокируя event loop."""
+    if isinstance(image, bytes):
+        return await analyzer.analyze_image_bytes_async(image, cpu_pool)
+    return await analyzer.analyze_image_async(image)
+
+
+async def compute_image_analysis(image: str | bytes) -> Dict[str, Any]:
     if analyzer is None:
         raise HTTPException(status_code=500, detail="Анализатор не инициализирован")
 
-    api_logger.info(f"[ANALYSIS] Запускаю анализ изображения: {image_path}")
-    analysis = analyzer.analyze_image(image_path)
+    api_logger.info("[ANALYSIS] Запускаю анализ изображения: %s", _describe_image(image))
+    analysis = await _analyze_image_source(image)
     if analysis.get("error"):
-        api_logger.error(f"[ANALYSIS] Ошибка анализа изображения: {analysis['error']}")
+        api_logger.error("[ANALYSIS] Ошибка анализа изображения: %s", analysis["error"])
     return {"analysis": analysis}
 
 
-def compute_full_analysis_by_path(image_path: str) -> Dict[str, Any]:
+async def compute_full_analysis(image: str | bytes) -> Dict[str, Any]:
     if analyzer is None or food_searcher is None:
         raise HTTPException(status_code=500, detail="Анализаторы не инициализированы")
 
-    api_logger.info(f"[FULL] Запускаю анализ изображения: {image_path}")
-    analysis = analyzer.analyze_image(image_path)
+    api_logger.info("[FULL] Запускаю анализ изображения: %s", _describe_image(image))
+    analysis = await _analyze_image_source(image)
     if analysis.get("error"):
-        api_logger.error(f"[FULL] Ошибка анализа изображения: {analysis['error']}")
+        api_logger.error("[FULL] Ошибка анализа изображения: %s", analysis["error"])
         return {"analysis": analysis, "nutrients": {"error": analysis.get("error")}}
 
     dishes = analysis.get("dishes", []) or []
@@ -204,10 +378,10 @@ def compute_full_analysis_by_path(image_path: str) -> Dict[str, Any]:
 
     if items:
         try:
-            api_logger.info(f"[FULL] Анализирую нутриенты для {len(items)} блюд")
-            nutrients = food_searcher.analyze_multiple_dishes_nutrients(items)
+            api_logger.info("[FULL] Анализирую нутриенты для %d блюд", len(items))
+            nutrients = await food_searcher.analyze_multiple_dishes_nutrients_async(items)
         except Exception as e:
-            api_logger.error(f"[FULL] Ошибка анализа нутриентов: {e}")
+            api_logger.error("[FULL] Ошибка анализа нутриентов: %s", e)
             nutrients = {"error": str(e), "dishes": []}
     else:
         nutrients = {"dishes": [], "total_dishes": 0, "successful_dishes": 0, "failed_dishes": 0}
@@ -221,74 +395,115 @@ JOB_TASKS: dict[str, asyncio.Task] = {}
 
 async def process_job(job_id: str) -> None:
     """Фоновая обработка задачи анализа (analysis | full)."""
-    api_logger.info(f"[JOB] Старт обработки job={job_id}")
-    update_job_status(job_id, "processing", None)
+    api_logger.info("[JOB] Старт обработки job=%s", job_id)
+    await queue_job_status(job_id, "processing")
 
-    job = get_job(job_id)
+    job = await asyncio.to_thread(get_job, job_id)
     if job is None:
-        api_logger.error(f"[JOB] job={job_id} не найдено")
+        api_logger.error("[JOB] job=%s не найдено", job_id)
         return
 
     params_json = job.get("params_json") or "{}"
     try:
-        params = json.loads(params_json)
-    except json.JSONDecodeError as e:
-        update_job_status(job_id, "error", f"Некорректный params_json: {e}")
+        params = orjson.loads(params_json)
+    except orjson.JSONDecodeError as e:
+        await asyncio.to_thread(update_job_status, job_id, "error", f"Некорректный params_json: {e}")
         return
 
     image_path_in = params.get("image_path")
     image_base64_in = params.get("image_base64")
-    filename_in = params.get("filename")
     image_url_in = params.get("image_url") or job.get("image_url")
     mode = (params.get("params") or {}).get("mode", "full")
 
-    temp_created = False
-    resolved_path = ""
     try:
-        resolved_path, temp_created = resolve_image_source(image_path_in, image_base64_in, filename_in, image_url_in)
-        if mode == "analysis":
-            result = compute_image_analysis_by_path(resolved_path)
-        else:
-            result = compute_full_analysis_by_path(resolved_path)
+        image = await resolve_image_source(image_path_in, image_base64_in, image_url_in)
+        async with analysis_slot():
+            if mode == "analysis":
+                result = await compute_image_analysis(image)
+            else:
+                result = await compute_full_analysis(image)
         if result.get("analysis", {}).get("error"):
-            update_job_status(job_id, "error", str(result["analysis"].get("error")))
+            await asyncio.to_thread(update_job_status, job_id, "error", str(result["analysis"].get("error")))
             return
-        update_job_result(job_id, result)
-        api_logger.info(f"[JOB] Готово job={job_id}")
+        await asyncio.to_thread(update_job_result, job_id, result)
+        api_logger.info("[JOB] Готово job=%s", job_id)
     except HTTPException as he:
-        update_job_status(job_id, "error", he.detail if isinstance(he.detail, str) else str(he.detail))
+        await asyncio.to_thread(update_job_status, job_id, "error", he.detail if isinstance(he.detail, str) else str(he.detail))
     except Exception as e:
-        api_logger.error(f"[JOB] Ошибка job={job_id}: {e}")
-        update_job_status(job_id, "error", str(e))
-    finally:
-        if temp_created and resolved_path:
-            try:
-                os.remove(resolved_path)
-            except Exception:
-                pass
+        api_logger.error("[JOB] Ошибка job=%s: %s", job_id, e)
+        await asyncio.to_thread(update_job_status, job_id, "error", str(e))
 
-def load_config(config_path: str = "config.yaml") -> Dict[str, Any]:
-    """Загружает конфигурацию из YAML файла."""
+
+def _write_config_cache(cache_path: Path, source_key: Dict[str, int], config: Dict[str, Any]) -> None:
+    """Атомарно записывает разобранную конфигурацию в JSON рядом с YAML."""
+    # Каталог с конфигурацией может быть только для чтения (образ, смонтированный том) —
+    # тогда кэш не пишем и каждый раз читаем YAML
+    if not os.access(cache_path.parent, os.W_OK):
+        return
     try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
+        with tempfile.NamedTemporaryFile("wb", dir=cache_path.parent, suffix=".tmp", delete=False) as tmp:
+            tmp.write(orjson.dumps({"source": source_key, "config": config}))
+        os.replace(tmp.name, cache_path)
+    except (OSError, TypeError) as e:
+        # Кэш необязателен: при ошибке записи просто читаем YAML в следующий раз
+        print(f"⚠️ Не удалось записать кэш конфигурации {cache_path}: {e}")
+
+
+def _read_config_cache(cache_path: Path, source_key: Dict[str, int]) -> Dict[str, Any] | None:
+    """Читает JSON-кэш, только если он построен ровно из этой версии YAML (mtime_ns и размер)."""
+    try:
+        cached = orjson.loads(cache_path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    if not isinstance(cached, dict) or cached.get("source") != source_key:
+        return None
+    return cached.get("config")
+
+
+@functools.lru_cache(maxsize=4)
+def _load_config_cached(config_path: str, source_mtime: int, source_size: int) -> Dict[str, Any]:
+    """Разбирает конфигурацию; mtime и размер входят в ключ кэша, поэтому правка файла его инвалидирует."""
+    source = Path(config_path)
+    cache_path = source.with_name(source.name + ".cache.json")
+    source_key = {"mtime_ns": source_mtime, "size": source_size}
+    config = _read_config_cache(cache_path, source_key)
+    if config is not None:
         return config
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = yaml.load(f, Loader=YamlLoader)
     except FileNotFoundError:
         raise FileNotFoundError(f"Файл конфигурации {config_path} не найден")
     except yaml.YAMLError as e:
         raise ValueError(f"Ошибка чтения конфигурации: {e}")
+    _write_config_cache(cache_path, source_key, config)
+    return config
 
 
-def setup_logging(log_config: Dict[str, Any]) -> logging.Logger:
-    """Настраивает логирование запросов в файл с ротацией."""
-    log_file = log_config.get("file", "logs/api_requests.log")
-    log_level = log_config.get("level", "INFO")
-    max_size_mb = log_config.get("max_size_mb", 50)
-    backup_count = log_config.get("backup_count", 5)
+def load_config(config_path: str = "config.yaml") -> Dict[str, Any]:
+    """Загружает конфигурацию из YAML файла.
+
+    Разобранная конфигурация сохраняется в JSON-файл рядом с YAML (config.yaml.cache.json)
+    вместе с mtime и размером исходного файла; JSON читается, только пока они совпадают,
+    что намного быстрее разбора YAML. Повторные вызовы для неизмененного файла возвращают
+    тот же словарь из памяти (его нельзя изменять).
+    """
+    try:
+        source_stat = os.stat(config_path)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Файл конфигурации {config_path} не найден")
+    return _load_config_cached(config_path, source_stat.st_mtime_ns, source_stat.st_size)
 
-    # Создаем директорию для логов если её нет
-    log_dir = Path(log_file).parent
-    log_dir.mkdir(parents=True, exist_ok=True)
+
+def setup_logging(log_config: Dict[str, Any]) -> tuple[logging.Logger, queue.SimpleQueue]:
+    """Настраивает логгер запросов, который только кладет записи в очередь.
+
+    Запись в файл (и ротация) выполняется в фоновом потоке QueueListener, не блокируя
+    event loop; слушатель запускается в lifespan (см. start_log_listener), поэтому импорт
+    модуля (в том числе в процессах пула как __mp_main__) не открывает файл лога и не
+    создает потоков. Записи, сделанные до запуска слушателя, ждут в очереди.
+    """
+    log_level = log_config.get("level", "INFO")
 
     # Настраиваем логгер
     logger = logging.getLogger("chain_server_api")
@@ -297,6 +512,21 @@ def setup_logging(log_config: Dict[str, Any]) -> logging.Logger:
     # Убираем существующие обработчики
     logger.handlers.clear()
 
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    return logger, log_queue
+
+
+def start_log_listener(log_config: Dict[str, Any], log_queue: queue.SimpleQueue) -> QueueListener:
+    """Запускает запись логов в файл с ротацией; слушатель нужно остановить при завершении работы."""
+    log_file = log_config.get("file", "logs/api_requests.log")
+    max_size_mb = log_config.get("max_size_mb", 50)
+    backup_count = log_config.get("backup_count", 5)
+
+    # Создаем директорию для логов если её нет
+    log_dir = Path(log_file).parent
+    log_dir.mkdir(parents=True, exist_ok=True)
+
     # Создаем форматтер
     formatter = logging.Formatter(
         '%(asctime)s - %(levelname)s - %(message)s',
@@ -312,15 +542,15 @@ def setup_logging(log_config: Dict[str, Any]) -> logging.Logger:
         encoding='utf-8'
     )
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
 
     # Консольный обработчик для ошибок
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.ERROR)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
 
-    return logger
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    return listener
 
 
 def create_food_analyzer_with_config(config: Dict[str, Any]) -> FoodImageAnalyzer:
@@ -328,9 +558,21 @@ def create_food_analyzer_with_config(config: Dict[str, Any]) -> FoodImageAnalyze
     image_config = config.get("image_recognition_model", {})
 
     return FoodImageAnalyzer(
-        model_name=image_config.get("model", "gpt-4o"),
+        model_name=image_config.get("model", "gpt-4o-mini"),
         temperature=image_config.get("temperature", 0.1),
-        max_tokens=image_config.get("max_tokens", 1000)
+        max_tokens=image_config.get("max_tokens", 500),
+        max_concurrency=image_config.get("max_concurrency", 10),
+        rpm=image_config.get("rpm", 500),
+        cache_path=image_config.get("cache_path"),
+        cache_ttl_seconds=int(image_config.get("cache_ttl_hours", 168)) * 3600,
+        fallback_model_name=image_config.get("fallback_model", "gpt-4o"),
+        escalation_threshold=image_config.get("escalation_threshold", 0.5),
+        low_detail_max_side=image_config.get("low_detail_max_side", 512),
+        image_detail=image_config.get("detail"),
+        max_image_side=image_config.get("max_image_side", 1024),
+        jpeg_quality=image_config.get("jpeg_quality", 75),
+        request_timeout=image_config.get("timeout"),
+        two_pass_detail=bool(image_config.get("two_pass_detail", False))
     )
 
 
@@ -349,13 +591,22 @@ def create_nutrients_analyzer_with_config(config: Dict[str, Any]) -> EdamamFoodS
         app_key=app_key,
         base_url=edamam_config.get("base_url"),
         timeout=edamam_config.get("timeout", 30),
-        max_results=edamam_config.get("max_results", 10),
-        model_name=nutrients_config.get("model", "gpt-4o"),
+        max_results=edamam_config.get("max_results", 2),
+        model_name=nutrients_config.get("model", "gpt-4o-mini"),
         temperature=nutrients_config.get("temperature", 0.5),
         max_tokens=nutrients_config.get("max_tokens", 800),
         request_timeout=nutrients_config.get("timeout", 45),
         debug_api_log=DEBUG_API_LOG,
-        debug_max_chars=DEBUG_MAX_CHARS
+        debug_max_chars=DEBUG_MAX_CHARS,
+        cache_path=nutrients_config.get("cache_path"),
+        cache_max_entries=nutrients_config.get("cache_max_entries", 1024),
+        semantic_cache_threshold=nutrients_config.get("semantic_cache_threshold", 0.95),
+        embedding_model=nutrients_config.get("embedding_model", "text-embedding-3-small"),
+        max_concurrent=nutrients_config.get("max_concurrent", 8),
+        edamam_cache_path=edamam_config.get("cache_path"),
+        edamam_cache_ttl_seconds=int(edamam_config.get("cache_ttl_hours", 168)) * 3600,
+        edamam_memory_cache_size=int(edamam_config.get("memory_cache_size", 4096)),
+        edamam_memory_cache_ttl_seconds=int(edamam_config.get("memory_cache_ttl_hours", 24)) * 3600
     )
 
 
@@ -367,14 +618,40 @@ DEBUG_SETTINGS = config.get("debug", {})
 DEBUG_API_LOG = bool(DEBUG_SETTINGS.get("api_log", False))
 DEBUG_MAX_CHARS = int(DEBUG_SETTINGS.get("max_print_chars", 2000))
 
+# Ограничение одновременных анализов: при всплеске задач запросы к OpenAI ждут здесь,
+# а не упираются в rate limit и лимит файловых дескрипторов
+MAX_CONCURRENT_ANALYSES = int(config.get("server", {}).get("max_concurrent_analyses", 16))
+ANALYSIS_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+# Число анализов, занявших слот (для /health); меняется только в event loop
+active_analyses = 0
+
+
+@asynccontextmanager
+async def analysis_slot():
+    """Занимает слот ANALYSIS_SEMAPHORE и учитывает его в active_analyses."""
+    global active_analyses
+    async with ANALYSIS_SEMAPHORE:
+        active_analyses += 1
+        try:
+            yield
+        finally:
+            active_analyses -= 1
+
+
 # Настраиваем логирование
 logging_config = config.get("logging", {})
-api_logger = setup_logging(logging_config)
+api_logger, log_queue = setup_logging(logging_config)
 
 # Глобальные экземпляры сервисов
 analyzer: FoodImageAnalyzer | None = None
 food_searcher: EdamamFoodSearcher | None = None
 
+# Пул процессов для CPU-части анализа (пережатие и кодирование изображений)
+cpu_pool: ProcessPoolExecutor | None = None
+
+# Неизменяемая после запуска часть ответа /health (заполняется в lifespan)
+HEALTH_STATIC: Dict[str, Any] = {"status": "healthy", "openai_key_set": False}
+
 
 def _require_env_vars(var_names: list[str]) -> None:
     """Проверяет наличие обязательных переменных окружения.
@@ -397,20 +674,31 @@ def validate_environment() -> None:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения."""
-    global analyzer, food_searcher
+    global analyzer, food_searcher, cpu_pool
 
     # Startup
+    log_listener = start_log_listener(logging_config, log_queue)
     api_logger.info("[STARTUP] Запуск chain-server...")
 
     # Проверяем необходимые переменные окружения до инициализации сервисов
     validate_environment()
+    HEALTH_STATIC["openai_key_set"] = bool(os.getenv("OPENAI_API_KEY"))
 
     try:
         # Инициализация БД задач
         init_db()
+        start_status_flusher()
         api_logger.info("[STARTUP] ✅ База задач инициализирована")
 
         analyzer = create_food_analyzer_with_config(config)
+        cpu_workers = server_config.get("cpu_workers")
+        if cpu_workers != 0:
+            # По умолчанию ядра делятся между воркерами uvicorn, чтобы не получить cpu_count² процессов.
+            # Процессы пула запускаются через forkserver (см. create_image_process_pool); сервер форков
+            # импортирует этот модуль как __mp_main__, поэтому на уровне модуля он не создает
+            # потоков и не открывает файлов (логирование запускается выше, в lifespan)
+            uvicorn_workers = int(server_config.get("workers") or 1)
+            cpu_pool = create_image_process_pool(cpu_workers or max(1, (os.cpu_count() or 1) // uvicorn_workers))
         api_logger.info("[STARTUP] ✅ Анализатор изображений инициализирован")
         print("✅ Анализатор изображений инициализирован")
 
@@ -422,17 +710,28 @@ async def lifespan(app: FastAPI):
         api_logger.info("[STARTUP] 🚀 Chain-server готов к работе")
 
     except Exception as e:
-        api_logger.error(f"[STARTUP] Ошибка инициализации сервисов: {str(e)}")
+        api_logger.error("[STARTUP] Ошибка инициализации сервисов: %s", e)
         raise
 
     yield
 
     # Shutdown
     api_logger.info("[SHUTDOWN] Завершение работы chain-server...")
+    if food_searcher is not None:
+        await food_searcher.aclose()
+    # Общие keep-alive пулы соединений к OpenAI закрываются один раз при остановке
+    await close_shared_http_clients()
+    if cpu_pool is not None:
+        cpu_pool.shutdown(cancel_futures=True)
+        cpu_pool = None
+    await stop_status_flusher()
+    close_db()
     analyzer = None
     food_searcher = None
     api_logger.info("[SHUTDOWN] 🔄 Анализаторы отключены")
     print("🔄 Анализаторы отключены")
+    # Дописываем накопившиеся в очереди записи и останавливаем поток логирования
+    log_listener.stop()
 
 
 class ImageAnalysisRequest(BaseModel):
@@ -449,6 +748,16 @@ class ImageAnalysisResponse(BaseModel):
     error: str | None = None
 
 
+class BatchNutrientsRequest(BaseModel):
+    """Запрос на анализ питательных веществ нескольких блюд (например, всего приема пищи)."""
+    items: list[FoodSearchRequest]
+
+
+class BatchNutrientsResponse(BaseModel):
+    """Результаты в порядке входных блюд; для неудачных блюд — словарь с ключом error."""
+    results: list[Dict[str, Any]]
+
+
 class JobCreateRequest(BaseModel):
     """Запрос на создание задачи анализа."""
     image_path: str | None = None
@@ -482,6 +791,8 @@ app = FastAPI(
     docs_url="/api/v1/docs",
     openapi_url="/api/v1/openapi.json",
     lifespan=lifespan,
+    # Ответы сериализуются orjson сразу в bytes, минуя стандартный json
+    default_response_class=ORJSONResponse,
 )
 
 # Добавляем CORS middleware
@@ -514,64 +825,60 @@ async def request_context_middleware(request: Request, call_next):
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     """Логирует все HTTP запросы."""
-    start_time = time.time()
+    # При уровне выше INFO строки логов не формируются и данные запроса не собираются
+    if not api_logger.isEnabledFor(logging.INFO):
+        try:
+            return await call_next(request)
+        except Exception as e:
+            api_logger.error("[ERROR] %s %s | Error: %s", request.method, request.url.path, e)
+            raise
+
+    start_ns = time.perf_counter_ns()
 
     # Получаем информацию о запросе
+    # Заголовки читаются напрямую из request.headers, без копирования в dict
     client_ip = request.client.host if request.client else "unknown"
     method = request.method
-    url = str(request.url)
-    headers = dict(request.headers)
-    user_agent = headers.get("user-agent", "unknown")
+    url = request.url.path
+    user_agent = request.headers.get("user-agent", "unknown")
 
     # Идентификаторы запроса
-    request_id = getattr(request.state, "request_id", headers.get("x-request-id", "unknown"))
+    request_id = getattr(request.state, "request_id", None) or request.headers.get("x-request-id", "unknown")
 
     # Логируем начало запроса
-    api_logger.info(f"[REQUEST] rid={request_id} | {method} {url} from {client_ip} | UA: {user_agent}")
+    api_logger.info("[REQUEST] rid=%s | %s %s from %s | UA: %s", request_id, method, url, client_ip, user_agent)
 
     # Обрабатываем запрос
     try:
         response = await call_next(request)
 
         # Вычисляем время обработки
-        process_time = time.time() - start_time
+        process_time = (time.perf_counter_ns() - start_ns) / 1e9
 
         # Логируем завершение запроса
         api_logger.info(
-            f"[RESPONSE] rid={request_id} | {method} {url} | Status: {response.status_code} | "
-            f"Time: {process_time:.3f}s | IP: {client_ip}"
+            "[RESPONSE] rid=%s | %s %s | Status: %s | Time: %.3fs | IP: %s",
+            request_id, method, url, response.status_code, process_time, client_ip
         )
 
         return response
 
     except Exception as e:
-        process_time = time.time() - start_time
+        process_time = (time.perf_counter_ns() - start_ns) / 1e9
         api_logger.error(
-            f"[ERROR] rid={request_id} | {method} {url} | Error: {str(e)} | "
-            f"Time: {process_time:.3f}s | IP: {client_ip}"
+            "[ERROR] rid=%s | %s %s | Error: %s | Time: %.3fs | IP: %s",
+            request_id, method, url, e, process_time, client_ip
         )
         raise
 
 
-
-
-def _save_base64_image(image_base64: str, filename: str) -> str:
-    """Сохраняет base64 изображение во временный файл."""
-    temp_dir = Path(FILES_SETTINGS["temp_dir"])
-    temp_dir.mkdir(exist_ok=True)
-
+def _decode_base64_image(image_base64: str) -> bytes:
+    """Декодирует base64 изображение (с префиксом data:image или без него)."""
     # Убираем префикс data:image если есть
-    if "," in image_base64:
-        image_base64 = image_base64.split(",")[1]
-
-    # Декодируем и сохраняем
-    image_data = base64.b64decode(image_base64)
-    temp_path = temp_dir / filename
-
-    with open(temp_path, "wb") as f:
-        f.write(image_data)
-
-    return str(temp_path)
+    prefix, separator, payload = image_base64.partition(",")
+    if not separator:
+        payload = prefix
+    return pybase64.b64decode(payload, validate=False)
 
 
 @app.post("/api/v1/analyze", response_model=JobCreateResponse, tags=["analysis"])
@@ -579,17 +886,43 @@ async def analyze_image_async(request: ImageAnalysisRequest) -> JobCreateRespons
     """Асинхронный анализ изображения: ставит задачу (mode=analysis) и возвращает job_id."""
     if not (request.image_path or request.image_base64 or request.filename or request):
         raise HTTPException(status_code=400, detail="Укажите image_path или image_base64")
+    validate_image_request(request.image_base64, request.filename)
     params: Dict[str, Any] = {
         "image_path": request.image_path,
         "image_base64": request.image_base64,
         "filename": request.filename,
         "params": {"mode": "analysis"},
     }
-    job_id = insert_job(None, params)
+    job_id = await asyncio.to_thread(insert_job, None, params)
     JOB_TASKS[job_id] = asyncio.create_task(process_job(job_id))
     return JobCreateResponse(job_id=job_id, status="queued")
 
 
+@app.post("/api/v1/analyze-stream", tags=["analysis"])
+async def analyze_image_stream(request: ImageAnalysisRequest) -> StreamingResponse:
+    """Потоковый анализ изображения (Server-Sent Events).
+
+    Каждое событие содержит частичный результат анализа; блюда появляются по мере
+    генерации ответа моделью, последнее событие — полный результат.
+    """
+    if analyzer is None:
+        raise HTTPException(status_code=500, detail="Анализатор не инициализирован")
+    validate_image_request(request.image_base64, request.filename)
+    try:
+        image = await resolve_image_source(request.image_path, request.image_base64, None)
+    except (ValueError, binascii.Error) as e:
+        # Нечитаемый файл или некорректный base64 — ошибка запроса, а не сервера
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def events():
+        async with analysis_slot():
+            async for partial in analyzer.analyze_image_stream(image, cpu_pool):
+                yield b"data: " + orjson.dumps(partial) + b"\n\n"
+
+    api_logger.info("[STREAM] Потоковый анализ изображения: %s", _describe_image(image))
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
 # Удалён синхронный эндпоинт нутриентов: нутриенты считаются только в режиме полной задачи
 
 
@@ -598,34 +931,74 @@ async def analyze_full_async(request: ImageAnalysisRequest) -> JobCreateResponse
     """Асинхронный полный анализ изображения: ставит задачу (mode=full) и возвращает job_id."""
     if not (request.image_path or request.image_base64 or request.filename or request):
         raise HTTPException(status_code=400, detail="Укажите image_path или image_base64")
+    validate_image_request(request.image_base64, request.filename)
     params: Dict[str, Any] = {
         "image_path": request.image_path,
         "image_base64": request.image_base64,
         "filename": request.filename,
         "params": {"mode": "full"},
     }
-    job_id = insert_job(None, params)
+    job_id = await asyncio.to_thread(insert_job, None, params)
     JOB_TASKS[job_id] = asyncio.create_task(process_job(job_id))
     return JobCreateResponse(job_id=job_id, status="queued")
 
 # Удалён эндпоинт множественного анализа нутриентов (не используется в асинхронной модели)
 
 
+@app.post("/api/v1/analyze-nutrients/batch", response_model=BatchNutrientsResponse, tags=["nutrients"])
+async def analyze_nutrients_batch(request: BatchNutrientsRequest) -> BatchNutrientsResponse:
+    """Анализ питательных веществ нескольких блюд за один запрос.
+
+    Блюда анализируются параллельно (по отдельному запросу к LLM на блюдо, число
+    одновременных запросов ограничено max_concurrent), повторы считаются один раз.
+    Слот ANALYSIS_SEMAPHORE не занимается: он ограничивает анализ изображений, и длинные
+    пакеты нутриентов не должны задерживать задачи /analyze.
+    """
+    if food_searcher is None:
+        raise HTTPException(status_code=500, detail="Анализатор питательных веществ не инициализирован")
+    if not request.items:
+        raise HTTPException(status_code=400, detail="Укажите хотя бы одно блюдо")
+
+    api_logger.info("[NUTRIENTS] Пакетный анализ нутриентов: %d блюд", len(request.items))
+    results = await food_searcher.analyze_dishes_async([item.model_dump() for item in request.items])
+    return BatchNutrientsResponse(results=results)
+
+
 @app.get("/api/v1/health", tags=["health"])
 async def health_check():
     """Проверка состояния сервера."""
     status = {
-        "status": "healthy",
+        **HEALTH_STATIC,
         "image_analyzer_ready": analyzer is not None,
         "nutrients_analyzer_ready": food_searcher is not None,
-        "openai_key_set": bool(os.getenv("OPENAI_API_KEY"))
+        "nutrient_cache": food_searcher.cache.stats() if food_searcher is not None else None,
+        "analysis_slots": {
+            "limit": MAX_CONCURRENT_ANALYSES,
+            "in_use": active_analyses,
+            "available": MAX_CONCURRENT_ANALYSES - active_analyses,
+        }
     }
 
-    api_logger.debug(f"[HEALTH] Проверка состояния | image_analyzer: {status['image_analyzer_ready']} | nutrients_analyzer: {status['nutrients_analyzer_ready']}")
+    api_logger.debug("[HEALTH] Проверка состояния | image_analyzer: %s | nutrients_analyzer: %s",
+                     status["image_analyzer_ready"], status["nutrients_analyzer_ready"])
 
     return status
 
 
+@app.get("/api/v1/health/ready", tags=["health"])
+async def readiness_check() -> Response:
+    """Проверка готовности для оркестратора: 503, пока анализаторы не инициализированы в lifespan."""
+    if analyzer is None or food_searcher is None:
+        return Response(content=b'{"ready":false}', status_code=503, media_type="application/json")
+    return Response(content=b'{"ready":true}', media_type="application/json")
+
+
+@app.get("/api/v1/healthz", tags=["health"])
+async def liveness_check() -> Response:
+    """Минимальная проверка для балансировщика: статичный ответ без сборки состояния."""
+    return Response(content=b'{"ok":true}', media_type="application/json")
+
+
 # Убраны LangServe цепочки и кастомизация OpenAPI — остаются только асинхронные REST эндпоинты
 
 
@@ -634,6 +1007,7 @@ async def create_job(request: JobCreateRequest) -> JobCreateResponse:
     """Создает задачу полного анализа изображения и ставит её в очередь."""
     if not (request.image_path or request.image_base64 or request.image_url):
         raise HTTPException(status_code=400, detail="Укажите image_path, image_base64 или image_url")
+    validate_image_request(request.image_base64, request.filename)
 
     params: Dict[str, Any] = {
         "image_path": request.image_path,
@@ -642,24 +1016,24 @@ async def create_job(request: JobCreateRequest) -> JobCreateResponse:
         "image_url": request.image_url,
         "params": request.params or {},
     }
-    job_id = insert_job(request.image_url, params)
+    job_id = await asyncio.to_thread(insert_job, request.image_url, params)
     task = asyncio.create_task(process_job(job_id))
     JOB_TASKS[job_id] = task
-    api_logger.info(f"[JOBS] Создана задача job={job_id}")
+    api_logger.info("[JOBS] Создана задача job=%s", job_id)
     return JobCreateResponse(job_id=job_id, status="queued")
 
 
 @app.get("/api/v1/jobs/{job_id}", response_model=JobStatusResponse, tags=["jobs"])
 async def get_job_status(job_id: str) -> JobStatusResponse:
-    job = get_job(job_id)
+    job = await asyncio.to_thread(get_job, job_id)
     if job is None:
         raise HTTPException(status_code=404, detail="Задача не найдена")
 
     result: Dict[str, Any] | None = None
     if job.get("result_json"):
         try:
-            result = json.loads(job["result_json"])
-        except json.JSONDecodeError:
+            result = orjson.loads(job["result_json"])
+        except orjson.JSONDecodeError:
             result = None
 
     return JobStatusResponse(
@@ -676,11 +1050,16 @@ async def get_job_status(job_id: str) -> JobStatusResponse:
 if __name__ == "__main__":
     import uvicorn
 
-    # Запуск сервера с настройками из конфигурации
-    server_config = config.get("server", {})
+    # Запуск сервера с настройками из конфигурации (server_config прочитан при создании app)
+    workers = int(server_config.get("workers") or 1)
+    # "auto" берет uvloop и httptools из uvicorn[standard], если они установлены; при нескольких воркерах приложение
+    # передается строкой импорта, каждый воркер создает свои анализаторы в lifespan
     uvicorn.run(
-        app,
+        "server:app" if workers > 1 else app,
         host=server_config.get("host", "0.0.0.0"),
         port=server_config.get("port", 8000),
-        log_level=server_config.get("log_level", "info")
+        log_level=server_config.get("log_level", "info"),
+        loop="auto",
+        http="auto",
+        workers=workers,
     )
\ No newline at end of file